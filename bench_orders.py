@@ -0,0 +1,238 @@
+import argparse
+import random
+import time
+import mysql.connector
+
+BENCH_DB = "shopping_app_bench"
+
+
+def setup_schema(cursor, products):
+    cursor.execute(f"DROP DATABASE IF EXISTS {BENCH_DB}")
+    cursor.execute(f"CREATE DATABASE {BENCH_DB}")
+    cursor.execute(f"USE {BENCH_DB}")
+
+    cursor.execute(
+        """
+        CREATE TABLE users (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            username VARCHAR(255) UNIQUE,
+            password VARCHAR(255)
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE products (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(255),
+            price_cents INT NOT NULL,
+            stock INT
+        )
+        """
+    )
+
+    # Legacy layout: one row per cart line
+    cursor.execute(
+        """
+        CREATE TABLE orders (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT,
+            product_id INT,
+            quantity INT,
+            order_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+            idempotency_key VARCHAR(64) NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (product_id) REFERENCES products(id),
+            UNIQUE KEY uniq_order_idempotency (idempotency_key, product_id)
+        )
+        """
+    )
+
+    # Grouped layout, as created by server.init_db
+    cursor.execute(
+        """
+        CREATE TABLE order_headers (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            order_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+            idempotency_key VARCHAR(64) NULL,
+            total_cents BIGINT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            UNIQUE KEY uniq_header_idempotency (user_id, idempotency_key),
+            KEY idx_headers_user (user_id, id)
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE order_lines (
+            order_id INT NOT NULL,
+            product_id INT NOT NULL,
+            quantity INT NOT NULL,
+            unit_price_cents INT NULL,
+            PRIMARY KEY (order_id, product_id),
+            FOREIGN KEY (order_id) REFERENCES order_headers(id),
+            FOREIGN KEY (product_id) REFERENCES products(id)
+        )
+        """
+    )
+
+    cursor.executemany(
+        "INSERT INTO products (name, price_cents, stock) VALUES (%s, %s, %s)",
+        [
+            (f"Product {i}", product_price_cents(i + 1), 1000000)
+            for i in range(products)
+        ],
+    )
+    cursor.executemany(
+        "INSERT INTO users (username, password) VALUES (%s, %s)",
+        [(f"user{i}", "pw") for i in range(10)],
+    )
+
+
+def product_price_cents(product_id):
+    return 999 + product_id
+
+
+def make_carts(count, lines, products):
+    rng = random.Random(42)
+    return [
+        (rng.randint(1, 10), rng.sample(range(1, products + 1), lines))
+        for _ in range(count)
+    ]
+
+
+def write_legacy(conn, cursor, carts):
+    statements = 0
+    start = time.perf_counter()
+    for user_id, product_ids in carts:
+        for product_id in product_ids:
+            cursor.execute(
+                "INSERT INTO orders (user_id, product_id, quantity) VALUES (%s, %s, %s)",
+                (user_id, product_id, 1),
+            )
+            statements += 1
+        conn.commit()
+    return time.perf_counter() - start, statements
+
+
+def write_grouped(conn, cursor, carts):
+    # Same statements as checkout in server.py: header (with its idempotency
+    # key), all lines in one multi-row INSERT, then the header total
+    statements = 0
+    start = time.perf_counter()
+    for cart_number, (user_id, product_ids) in enumerate(carts):
+        cursor.execute(
+            "INSERT INTO order_headers (user_id, idempotency_key) VALUES (%s, %s)",
+            (user_id, f"bench-{cart_number}"),
+        )
+        order_id = cursor.lastrowid
+        lines = [
+            (order_id, product_id, 1, product_price_cents(product_id))
+            for product_id in product_ids
+        ]
+        cursor.executemany(
+            "INSERT INTO order_lines (order_id, product_id, quantity, unit_price_cents) VALUES (%s, %s, %s, %s)",
+            lines,
+        )
+        cursor.execute(
+            "UPDATE order_headers SET total_cents = %s WHERE id = %s",
+            (sum(line[2] * line[3] for line in lines), order_id),
+        )
+        statements += 3
+        conn.commit()
+    return time.perf_counter() - start, statements
+
+
+def table_bytes(cursor, *tables):
+    total = 0
+    for table in tables:
+        cursor.execute(f"ANALYZE TABLE {table}")
+        cursor.fetchall()
+        cursor.execute(
+            """
+            SELECT DATA_LENGTH + INDEX_LENGTH FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s
+            """,
+            (BENCH_DB, table),
+        )
+        total += cursor.fetchone()[0]
+    return total
+
+
+def time_query(cursor, sql, params, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        cursor.execute(sql, params)
+        cursor.fetchall()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare per-line orders with order_headers/order_lines"
+    )
+    parser.add_argument("--carts", type=int, default=2000)
+    parser.add_argument("--lines", type=int, default=5, help="Lines per cart")
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    conn = mysql.connector.connect(user="shopping_user", password="shopping_password")
+    cursor = conn.cursor()
+    setup_schema(cursor, args.products)
+    conn.commit()
+
+    carts = make_carts(args.carts, args.lines, args.products)
+
+    legacy_time, legacy_statements = write_legacy(conn, cursor, carts)
+    grouped_time, grouped_statements = write_grouped(conn, cursor, carts)
+    legacy_bytes = table_bytes(cursor, "orders")
+    grouped_bytes = table_bytes(cursor, "order_headers", "order_lines")
+
+    print(f"[BENCH] {args.carts} carts x {args.lines} lines")
+    print(
+        f"[BENCH] per-line orders : {legacy_time:.3f}s, "
+        f"{legacy_statements / args.carts:.1f} statements/cart, {legacy_bytes} bytes"
+    )
+    print(
+        f"[BENCH] headers + lines : {grouped_time:.3f}s, "
+        f"{grouped_statements / args.carts:.1f} statements/cart, {grouped_bytes} bytes"
+    )
+
+    legacy_history = time_query(
+        cursor,
+        """
+        SELECT orders.id, orders.product_id, orders.quantity, orders.order_time, products.name AS product_name
+        FROM orders
+        JOIN products ON orders.product_id = products.id
+        WHERE orders.user_id = %s
+        """,
+        (1,),
+        args.repeat,
+    )
+    grouped_history = time_query(
+        cursor,
+        """
+        SELECT order_lines.order_id, order_lines.product_id, order_lines.quantity, products.name AS product_name
+        FROM order_lines
+        JOIN products ON order_lines.product_id = products.id
+        WHERE order_lines.order_id IN (
+            SELECT id FROM (
+                SELECT id FROM order_headers WHERE user_id = %s ORDER BY id DESC LIMIT 20
+            ) AS page
+        )
+        """,
+        (1,),
+        args.repeat,
+    )
+    print(f"[BENCH] history, full per-line scan : {legacy_history * 1000:.2f} ms")
+    print(f"[BENCH] history, first grouped page : {grouped_history * 1000:.2f} ms")
+
+    cursor.execute(f"DROP DATABASE {BENCH_DB}")
+    cursor.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import random
+import time
+
+from catalog_index import CatalogIndex
+
+WORDS = [
+    "apple", "banana", "mango", "peach", "orange", "papaya", "melon", "grape",
+    "cherry", "plum", "kiwi", "lemon", "lime", "guava", "berry", "coconut",
+    "organic", "fresh", "dried", "juice", "pack", "large", "small", "premium",
+]
+
+
+def make_products(count):
+    rng = random.Random(42)
+    return [
+        {
+            "id": product_id,
+            "name": " ".join(rng.sample(WORDS, 3)) + f" {product_id}",
+            "price_cents": rng.randint(500, 50000),
+            "stock": rng.choice([0, rng.randint(1, 500)]),
+        }
+        for product_id in range(1, count + 1)
+    ]
+
+
+def time_search(index, repeat, **kwargs):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        total, _ = index.search(**kwargs)
+    return (time.perf_counter() - start) / repeat * 1000, total
+
+
+def scan_search(products, query):
+    return sorted(
+        (product for product in products if query in product["name"].lower()),
+        key=lambda product: (product["name"].lower(), product["id"]),
+    )[:50]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark search_products")
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    products = make_products(args.products)
+    index = CatalogIndex()
+    start = time.perf_counter()
+    index.load(products)
+    print(
+        f"[BENCH] Indexed {args.products} products in "
+        f"{time.perf_counter() - start:.2f}s"
+    )
+
+    cases = [
+        ("substring 'coconut 12'", {"query": "coconut 12"}),
+        ("substring 'mango'", {"query": "mango"}),
+        ("prefix 'premium'", {"query": "premium", "mode": "prefix"}),
+        ("short substring 'ki'", {"query": "ki"}),
+        (
+            "price 100-120",
+            {"min_price_cents": 10000, "max_price_cents": 12000, "sort": "price"},
+        ),
+        (
+            "'berry' in stock, price <= 50",
+            {"query": "berry", "max_price_cents": 5000, "in_stock": True},
+        ),
+        ("all, sort by stock desc", {"sort": "stock", "descending": True}),
+    ]
+    for label, kwargs in cases:
+        elapsed, total = time_search(index, args.repeat, **kwargs)
+        print(f"[BENCH] {label:<32} {elapsed:8.2f} ms  ({total} matches)")
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        scan_search(products, "coconut 12")
+    elapsed = (time.perf_counter() - start) / args.repeat * 1000
+    print(f"[BENCH] {'linear scan baseline':<32} {elapsed:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+# File layout: an 8-byte magic, then records appended back to back. Each
+# record is a fixed header followed by `length` bytes of request JSON, with
+# any session token replaced by its sha256 digest.
+MAGIC = b"SHPCAP02"
+# timestamp (ns since the epoch), connection id, payload length, kind
+RECORD = struct.Struct("<qQIB3x")
+
+OPEN = 0
+REQUEST = 1
+CLOSE = 2
+# Digest of a session token issued by a login; lets a replay map captured
+# tokens to new ones without the capture holding live credentials
+SESSION = 3
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def redact(payload):
+    """Replace the session token in a request (resume) with its digest."""
+    if b'"session_token"' not in payload:
+        return payload
+    try:
+        request = json.loads(payload)
+        token = request["session_token"]
+    except (ValueError, TypeError, KeyError):
+        return payload
+    if not isinstance(token, str):
+        return payload
+    request["session_token"] = token_digest(token)
+    return json.dumps(request, separators=(",", ":")).encode("utf-8")
+
+
+class CaptureWriter:
+    """Appends every request the server receives to a capture file."""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        # Unbuffered: each record reaches the file in a single write, so a
+        # crash loses at most the record being written. Requests include login
+        # passwords, so a new file is readable by its owner only.
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.file = open(fd, "ab", buffering=0)
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def record(self, connection_id, kind, payload=b""):
+        header = RECORD.pack(time.time_ns(), connection_id, len(payload), kind)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(header + payload)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_capture(path):
+    """Yield (timestamp_ns, connection_id, kind, payload) for every record."""
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[: len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a capture file")
+            offset = len(MAGIC)
+            # A record cut short by a crash is ignored
+            while offset + RECORD.size <= len(data):
+                timestamp, connection_id, length, kind = RECORD.unpack_from(
+                    data, offset
+                )
+                offset += RECORD.size
+                if offset + length > len(data):
+                    break
+                yield timestamp, connection_id, kind, data[offset : offset + length]
+                offset += length
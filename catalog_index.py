@@ -0,0 +1,198 @@
+import bisect
+import heapq
+import threading
+
+SORT_KEYS = ("name", "price", "stock", "id")
+SORT_FIELDS = {"price": "price_cents", "stock": "stock", "id": "id"}
+
+
+def trigrams(text):
+    text = text.lower()
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class CatalogIndex:
+    """In-memory product catalog with a trigram index over product names.
+
+    Substring queries of three or more characters intersect trigram posting
+    sets and then confirm the match; prefix queries binary-search a sorted
+    name list. Price ranges are answered from a sorted price list, so only
+    the remaining filters touch individual products.
+
+    Products may carry a "version" (the row's updated_at as a sortable
+    string); a change is only applied if it is newer than what is stored.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.products = {}
+        self.postings = {}
+        self.names = []
+        self.prices = []
+        self.versions = {}
+        # Bumped on every change so callers can cache derived data
+        self.version = 0
+
+    def load(self, products):
+        with self.lock:
+            self.products = {}
+            self.postings = {}
+            self.versions = {}
+            for product in products:
+                product = dict(product)
+                self.versions[product["id"]] = product.pop("version", None)
+                self.products[product["id"]] = product
+                for gram in trigrams(product["name"]):
+                    self.postings.setdefault(gram, set()).add(product["id"])
+            self.names = sorted(
+                (product["name"].lower(), product_id)
+                for product_id, product in self.products.items()
+            )
+            self.prices = sorted(
+                (product["price_cents"], product_id)
+                for product_id, product in self.products.items()
+            )
+            self.version += 1
+
+    def _is_newer(self, product_id, version):
+        current = self.versions.get(product_id)
+        return version is None or current is None or version > current
+
+    def _remove(self, product_id):
+        product = self.products.pop(product_id)
+        for gram in trigrams(product["name"]):
+            postings = self.postings[gram]
+            postings.discard(product_id)
+            if not postings:
+                del self.postings[gram]
+        name_key = (product["name"].lower(), product_id)
+        del self.names[bisect.bisect_left(self.names, name_key)]
+        price_key = (product["price_cents"], product_id)
+        del self.prices[bisect.bisect_left(self.prices, price_key)]
+
+    def _add(self, product):
+        product_id = product["id"]
+        self.products[product_id] = product
+        for gram in trigrams(product["name"]):
+            self.postings.setdefault(gram, set()).add(product_id)
+        bisect.insort(self.names, (product["name"].lower(), product_id))
+        bisect.insort(self.prices, (product["price_cents"], product_id))
+
+    def update_stock(self, product_id, stock, version=None):
+        with self.lock:
+            product = self.products.get(product_id)
+            if product is not None and self._is_newer(product_id, version):
+                product["stock"] = stock
+                if version is not None:
+                    self.versions[product_id] = version
+                self.version += 1
+
+    def merge(self, products):
+        """Apply changed rows, e.g. from a refresh; returns how many were newer."""
+        applied = 0
+        with self.lock:
+            for product in products:
+                product = dict(product)
+                product_id = product["id"]
+                version = product.pop("version", None)
+                if not self._is_newer(product_id, version):
+                    continue
+                if product_id in self.products:
+                    self._remove(product_id)
+                self._add(product)
+                self.versions[product_id] = version
+                applied += 1
+            if applied:
+                self.version += 1
+        return applied
+
+    def snapshot(self):
+        """Return (version, all products ordered by id)."""
+        with self.lock:
+            return self.version, [
+                dict(self.products[product_id]) for product_id in sorted(self.products)
+            ]
+
+    def _match_query(self, query, mode):
+        query = query.lower()
+        if mode == "prefix":
+            start = bisect.bisect_left(self.names, (query,))
+            matches = set()
+            for name, product_id in self.names[start:]:
+                if not name.startswith(query):
+                    break
+                matches.add(product_id)
+            return matches
+
+        if len(query) < 3:
+            return {
+                product_id
+                for product_id, product in self.products.items()
+                if query in product["name"].lower()
+            }
+
+        # Intersect the rarest trigrams first to keep the candidate set small
+        grams = sorted(
+            trigrams(query), key=lambda gram: len(self.postings.get(gram, ()))
+        )
+        candidates = set(self.postings.get(grams[0], ()))
+        for gram in grams[1:]:
+            candidates &= self.postings.get(gram, set())
+            if not candidates:
+                break
+        return {
+            product_id
+            for product_id in candidates
+            if query in self.products[product_id]["name"].lower()
+        }
+
+    def _match_price(self, min_price_cents, max_price_cents):
+        low = 0
+        high = len(self.prices)
+        if min_price_cents is not None:
+            low = bisect.bisect_left(self.prices, (min_price_cents,))
+        if max_price_cents is not None:
+            high = bisect.bisect_right(self.prices, (max_price_cents, float("inf")))
+        return {product_id for _, product_id in self.prices[low:high]}
+
+    def search(
+        self,
+        query="",
+        mode="substring",
+        min_price_cents=None,
+        max_price_cents=None,
+        in_stock=False,
+        sort="name",
+        descending=False,
+        offset=0,
+        limit=50,
+    ):
+        """Return (total matches, one page of matching products)."""
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key: {sort}")
+
+        with self.lock:
+            matches = None
+            if query:
+                matches = self._match_query(query, mode)
+            if min_price_cents is not None or max_price_cents is not None:
+                in_range = self._match_price(min_price_cents, max_price_cents)
+                matches = in_range if matches is None else matches & in_range
+            if matches is None:
+                matches = self.products.keys()
+
+            results = [self.products[product_id] for product_id in matches]
+            if in_stock:
+                results = [product for product in results if product["stock"] > 0]
+
+            if sort == "name":
+                key = lambda product: (product["name"].lower(), product["id"])
+            else:
+                field = SORT_FIELDS[sort]
+                key = lambda product: (product[field], product["id"])
+
+            # Only the rows up to the end of the requested page need ordering
+            select = heapq.nlargest if descending else heapq.nsmallest
+            ranked = select(offset + limit, results, key=key)
+            page = [dict(product) for product in ranked[offset:]]
+        return len(results), page
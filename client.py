@@ -4,7 +4,74 @@ import socket
 import json
 import threading
 import time
+import uuid
+import random
 import argparse
+from decimal import Decimal, InvalidOperation
+
+PRODUCT_PAGE_SIZE = 100
+# Broadcast-driven UI updates are batched and applied once per frame
+FRAME_MS = 16
+# Automatic reconnect: full-jitter exponential backoff, then a manual prompt
+RECONNECT_BASE_DELAY = 1.0
+RECONNECT_MAX_DELAY = 30.0
+RECONNECT_ATTEMPTS = 8
+
+
+def format_price(cents):
+    return f"₹{cents // 100}.{cents % 100:02d}"
+
+
+def parse_price(text):
+    """Parse a rupee amount typed by the user into integer paise."""
+    try:
+        cents = Decimal(text.strip()) * 100
+    except InvalidOperation:
+        raise ValueError(f"Invalid price: {text}")
+    if not cents.is_finite() or cents != cents.to_integral_value():
+        raise ValueError(f"Invalid price: {text}")
+    return int(cents)
+
+
+class TreeIndex:
+    """Keeps a Treeview in sync with keyed rows without rebuilding it.
+
+    Rows are looked up by key in O(1), and render() only touches the Tk items
+    whose values or position actually changed.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.rows = {}
+
+    def render(self, rows):
+        keys = {key for key, _ in rows}
+        stale = [key for key in self.rows if key not in keys]
+        if stale:
+            self.tree.delete(*[self.rows.pop(key)[0] for key in stale])
+
+        for position, (key, values) in enumerate(rows):
+            values = tuple(values)
+            entry = self.rows.get(key)
+            if entry is None:
+                item_id = self.tree.insert("", position, values=values)
+            else:
+                item_id, old_values = entry
+                if old_values != values:
+                    self.tree.item(item_id, values=values)
+                if self.tree.index(item_id) != position:
+                    self.tree.move(item_id, "", position)
+            self.rows[key] = (item_id, values)
+
+    def update(self, key, column, value):
+        entry = self.rows.get(key)
+        if entry is None:
+            return None
+        item_id, values = entry
+        values = values[:column] + (value,) + values[column + 1 :]
+        self.tree.item(item_id, values=values)
+        self.rows[key] = (item_id, values)
+        return values
 
 
 class ServerConfigDialog(tk.Toplevel):
@@ -80,9 +147,22 @@ class ShoppingClient:
         self.client = None
         self.username = None
         self.cart = []
+        self.cart_total_cents = 0
+        self.checkout_key = None
         self.products = []
         self.connected = False
         self.listener_thread = None
+        self.reconnect_delay = None
+        self.reconnecting = False
+        self.closing = False
+        self.session_token = None
+        self.catalog_version = None
+        self.newest_order_id = None
+        self.pending_stock = {}
+        self.pending_stock_lock = threading.Lock()
+        self.stock_flush_scheduled = False
+        self.notification = None
+        self.ui_timings = {}
         self.server_host = server_host
         self.server_port = server_port
 
@@ -135,18 +215,42 @@ class ShoppingClient:
             return False
 
     def listen_for_broadcasts(self):
+        # Messages are newline-delimited; one recv may hold several of them
+        # (the server coalesces writes) or only part of one.
+        buffer = b""
         while self.connected:
             try:
-                response = self.client.recv(4096)
-                if not response:
-                    self.connected = False
-                    self.root.after(0, self.show_reconnect_prompt)
-                    break
-
-                data = json.loads(response.decode("utf-8"))
+                line, separator, rest = buffer.partition(b"\n")
+                if not separator:
+                    response = self.client.recv(65536)
+                    if not response:
+                        self.connected = False
+                        self.root.after(0, self.start_reconnect)
+                        break
+                    buffer += response
+                    continue
+                buffer = rest
+                if not line.strip():
+                    continue
+
+                data = json.loads(line.decode("utf-8"))
 
                 if data.get("action") == "stock_update":
-                    self.root.after(0, lambda d=data: self.handle_stock_update(d))
+                    self.queue_stock_update(data)
+                elif data.get("action") == "server_restarting":
+                    self.reconnect_delay = data.get("reconnect_delay")
+                    self.root.after(
+                        0,
+                        lambda: self.status_var.set(
+                            "Server is restarting - reconnecting shortly"
+                        ),
+                    )
+                elif (
+                    data.get("idempotency_key", self.checkout_key)
+                    != self.checkout_key
+                ):
+                    # Late answer to a checkout attempt we already retried
+                    continue
                 else:
                     self.response_data = data
                     self.response_received.set()
@@ -154,35 +258,184 @@ class ShoppingClient:
                 if self.connected:
                     print(f"Listener error: {str(e)}")
                     self.connected = False
-                    self.root.after(0, self.show_reconnect_prompt)
+                    self.root.after(0, self.start_reconnect)
                 break
 
-    def handle_stock_update(self, data):
+    def start_reconnect(self):
+        if self.reconnecting or self.closing:
+            return
+        self.reconnecting = True
+        self.status_var.set("Connection lost - reconnecting...")
+        threading.Thread(target=self.reconnect_loop, daemon=True).start()
+
+    def reconnect_loop(self):
+        """Reconnect in the background with jittered exponential backoff.
+
+        A server_restarting hint sets the first delay; after that each wait is
+        drawn uniformly from [0, base * 2**attempt] so clients that dropped
+        together do not come back together.
+        """
+        started = time.time()
+        first_delay = self.reconnect_delay
+        self.reconnect_delay = None
+        for attempt in range(RECONNECT_ATTEMPTS):
+            if attempt == 0 and first_delay is not None:
+                delay = first_delay
+            else:
+                delay = random.uniform(
+                    0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2**attempt)
+                )
+            time.sleep(delay)
+            if self.closing:
+                return
+            try:
+                client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                client.settimeout(10)
+                client.connect((self.server_host, self.server_port))
+                client.settimeout(None)
+            except OSError as e:
+                print(f"Reconnect attempt {attempt + 1} failed: {e}")
+                continue
+
+            print(
+                f"Reconnected after {attempt + 1} attempt(s) in "
+                f"{time.time() - started:.1f}s"
+            )
+            self.client = client
+            self.connected = True
+            self.root.after(0, self.on_reconnected)
+            return
+
+        self.reconnecting = False
+        self.root.after(0, self.show_reconnect_prompt)
+
+    def on_reconnected(self):
+        self.reconnecting = False
+        self.listener_thread = threading.Thread(
+            target=self.listen_for_broadcasts, daemon=True
+        )
+        self.listener_thread.start()
+        self.status_var.set(f"Connected to {self.server_host}:{self.server_port}")
+
+        if self.session_token and self.resume_session():
+            return
+
+        # No session to resume, or it expired: fall back to a fresh login
+        if self.username is not None:
+            messagebox.showinfo(
+                "Reconnected", "Connection re-established. Please log in again."
+            )
+        self.username = None
+        self.session_token = None
+        self.checkout_key = None
+        self.cart = []
+        self.update_cart_view()
+        self.notebook.select(self.login_frame)
+        self.notebook.tab(2, state="disabled")
+        self.notebook.tab(3, state="disabled")
+        self.notebook.tab(4, state="disabled")
+        self.notebook.tab(5, state="disabled")
+
+    def resume_session(self):
+        """Pick the session back up, fetching only what changed while offline."""
+        response = self.send_and_receive(
+            {
+                "action": "resume",
+                "session_token": self.session_token,
+                "catalog_version": self.catalog_version,
+                "after_order_id": self.newest_order_id,
+                # Lets the server report a checkout whose response was lost
+                "checkout_key": self.checkout_key,
+                "cart": [
+                    {"id": item["id"], "quantity": item["quantity"]}
+                    for item in self.cart
+                ],
+            }
+        )
+        if not response or response["status"] != "success":
+            return False
+
+        self.username = response["username"]
+        self.catalog_version = response["catalog_version"]
+        for product in response["products"]:
+            self.queue_stock_update(
+                {"product_id": product["id"], "new_stock": product["stock"]}
+            )
+        for order in sorted(response["orders"], key=lambda order: order["id"]):
+            self.insert_history_order(order, 0)
+            self.newest_order_id = order["id"]
+        self.cart = response["cart"]
+        self.update_cart_view()
+
+        # The pending key is kept otherwise, so retrying checkout is still safe
+        checkout = response.get("checkout")
+        if checkout:
+            self.checkout_key = None
+            message = (
+                f"Order #{checkout['order_id']} went through before the disconnect."
+            )
+            if checkout.get("total_cents") is not None:
+                message += f"\nTotal charged: {format_price(checkout['total_cents'])}"
+            messagebox.showinfo("Order Placed", message)
+        return True
+
+    def queue_stock_update(self, data):
         product_id = data.get("product_id")
         new_stock = data.get("new_stock")
         if product_id is None or new_stock is None:
             return
+        version = data.get("catalog_version")
+        if version and (self.catalog_version is None or version > self.catalog_version):
+            self.catalog_version = version
+
+        # Called from the listener thread: only the first update in a frame
+        # schedules a flush, later ones just overwrite the pending value.
+        with self.pending_stock_lock:
+            self.pending_stock[product_id] = new_stock
+            schedule = not self.stock_flush_scheduled
+            self.stock_flush_scheduled = True
+        if schedule:
+            self.root.after(FRAME_MS, self.flush_stock_updates)
+
+    def flush_stock_updates(self):
+        started = time.perf_counter()
+        with self.pending_stock_lock:
+            updates = self.pending_stock
+            self.pending_stock = {}
+            self.stock_flush_scheduled = False
         self.last_stock_update_time = time.time()
 
-        for i, product in enumerate(self.products):
-            if product["id"] == product_id:
-                self.products[i]["stock"] = new_stock
-                break
-
-        for item_id in self.products_tree.get_children():
-            item = self.products_tree.item(item_id)
-            values = item["values"]
-            if values and values[0] == product_id:
-                new_values = list(values)
-                new_values[3] = new_stock
-                self.products_tree.item(item_id, values=new_values)
-
-                self.show_notification(
-                    f"Product {values[1]} stock updated to {new_stock}"
-                )
-                break
+        changed = []
+        for product_id, new_stock in updates.items():
+            product = self.products_by_id.get(product_id)
+            if product is not None:
+                product["stock"] = new_stock
+            values = self.products_rows.update(product_id, 3, new_stock)
+            if values is not None:
+                changed.append((values[1], new_stock))
+
+        if len(changed) == 1:
+            name, new_stock = changed[0]
+            self.show_notification(f"Product {name} stock updated to {new_stock}")
+        elif changed:
+            self.show_notification(f"Stock updated for {len(changed)} products")
+        self.record_ui_time("stock_update", started)
+
+    def record_ui_time(self, name, started):
+        elapsed = time.perf_counter() - started
+        count, total, worst = self.ui_timings.get(name, (0, 0.0, 0.0))
+        self.ui_timings[name] = (count + 1, total + elapsed, max(worst, elapsed))
 
     def show_notification(self, message):
+        # Reuse the visible notification instead of stacking new windows
+        if self.notification is not None and self.notification.winfo_exists():
+            self.notification_label.config(text=message)
+            self.notification.after_cancel(self.notification_timer)
+            self.notification_timer = self.notification.after(
+                3000, self.notification.destroy
+            )
+            return
+
         notification = tk.Toplevel(self.root)
         notification.overrideredirect(True)
         notification.attributes("-topmost", True)
@@ -202,11 +455,13 @@ class ShoppingClient:
         frame = ttk.Frame(notification, style="Notification.TFrame")
         frame.pack(fill=tk.BOTH, expand=True)
 
-        ttk.Label(frame, text=message, wraplength=280).pack(pady=10, padx=10)
+        self.notification_label = ttk.Label(frame, text=message, wraplength=280)
+        self.notification_label.pack(pady=10, padx=10)
 
-        notification.after(3000, notification.destroy)
+        self.notification = notification
+        self.notification_timer = notification.after(3000, notification.destroy)
 
-    def send_and_receive(self, data):
+    def send_and_receive(self, data, retries=0):
         if not self.connected:
             messagebox.showerror("Not Connected", "Not connected to server")
             return None
@@ -215,13 +470,14 @@ class ShoppingClient:
         self.response_data = None
 
         try:
-            self.send(data)
+            for attempt in range(retries + 1):
+                self.send(data)
 
-            if self.response_received.wait(10.0):
-                return self.response_data
-            else:
-                messagebox.showerror("Timeout", "Server response timeout")
-                return None
+                if self.response_received.wait(10.0):
+                    return self.response_data
+
+            messagebox.showerror("Timeout", "Server response timeout")
+            return None
         except Exception as e:
             messagebox.showerror("Communication Error", str(e))
             return None
@@ -230,7 +486,7 @@ class ShoppingClient:
         try:
             if not self.client or not self.connected:
                 raise ConnectionError("Not connected to server")
-            self.client.sendall(json.dumps(data).encode("utf-8"))
+            self.client.sendall(json.dumps(data).encode("utf-8") + b"\n")
         except Exception as e:
             self.connected = False
             raise e
@@ -251,22 +507,26 @@ class ShoppingClient:
         self.products_frame = ttk.Frame(self.notebook)
         self.cart_frame = ttk.Frame(self.notebook)
         self.history_frame = ttk.Frame(self.notebook)
+        self.stats_frame = ttk.Frame(self.notebook)
 
         self.notebook.add(self.login_frame, text="Login")
         self.notebook.add(self.register_frame, text="Register")
         self.notebook.add(self.products_frame, text="Products")
         self.notebook.add(self.cart_frame, text="Cart")
         self.notebook.add(self.history_frame, text="Order History")
+        self.notebook.add(self.stats_frame, text="Sales Stats")
 
         self.setup_login_frame()
         self.setup_register_frame()
         self.setup_products_frame()
         self.setup_cart_frame()
         self.setup_history_frame()
+        self.setup_stats_frame()
 
         self.notebook.tab(2, state="disabled")
         self.notebook.tab(3, state="disabled")
         self.notebook.tab(4, state="disabled")
+        self.notebook.tab(5, state="disabled")
 
         self.status_var = tk.StringVar()
         self.status_var.set(f"Connected to {self.server_host}:{self.server_port}")
@@ -312,13 +572,67 @@ class ShoppingClient:
         frame.pack(fill=tk.BOTH, expand=True)
 
         ttk.Label(frame, text="Products", font=("Arial", 16)).pack(pady=10)
-        ttk.Button(frame, text="Refresh", command=self.load_products).pack(pady=5)
+
+        search_frame = ttk.Frame(frame)
+        search_frame.pack(pady=5)
+
+        self.search_var = tk.StringVar()
+        self.min_price_var = tk.StringVar()
+        self.max_price_var = tk.StringVar()
+        self.in_stock_var = tk.BooleanVar()
+        self.sort_var = tk.StringVar(value="name")
+
+        ttk.Label(search_frame, text="Search:").pack(side=tk.LEFT, padx=2)
+        search_entry = ttk.Entry(search_frame, textvariable=self.search_var, width=25)
+        search_entry.pack(side=tk.LEFT, padx=2)
+        search_entry.bind("<Return>", lambda event: self.search_products())
+        ttk.Label(search_frame, text="Price:").pack(side=tk.LEFT, padx=2)
+        ttk.Entry(search_frame, textvariable=self.min_price_var, width=8).pack(
+            side=tk.LEFT, padx=2
+        )
+        ttk.Label(search_frame, text="to").pack(side=tk.LEFT, padx=2)
+        ttk.Entry(search_frame, textvariable=self.max_price_var, width=8).pack(
+            side=tk.LEFT, padx=2
+        )
+        ttk.Checkbutton(
+            search_frame, text="In stock", variable=self.in_stock_var
+        ).pack(side=tk.LEFT, padx=5)
+        ttk.Label(search_frame, text="Sort:").pack(side=tk.LEFT, padx=2)
+        ttk.Combobox(
+            search_frame,
+            textvariable=self.sort_var,
+            values=("name", "price", "stock"),
+            state="readonly",
+            width=8,
+        ).pack(side=tk.LEFT, padx=2)
+        ttk.Button(search_frame, text="Search", command=self.search_products).pack(
+            side=tk.LEFT, padx=5
+        )
+        ttk.Button(search_frame, text="Refresh", command=self.load_products).pack(
+            side=tk.LEFT, padx=5
+        )
 
         columns = ("id", "name", "price", "stock")
         self.products_tree = ttk.Treeview(frame, columns=columns, show="headings")
         for col in columns:
             self.products_tree.heading(col, text=col.capitalize())
         self.products_tree.pack(fill=tk.BOTH, expand=True)
+        self.products_rows = TreeIndex(self.products_tree)
+        self.products_by_id = {}
+
+        page_frame = ttk.Frame(frame)
+        page_frame.pack(pady=5)
+        ttk.Button(
+            page_frame, text="< Prev", command=lambda: self.change_product_page(-1)
+        ).pack(side=tk.LEFT, padx=5)
+        self.page_label = ttk.Label(page_frame, text="")
+        self.page_label.pack(side=tk.LEFT, padx=5)
+        ttk.Button(
+            page_frame, text="Next >", command=lambda: self.change_product_page(1)
+        ).pack(side=tk.LEFT, padx=5)
+
+        self.product_offset = 0
+        self.product_total = 0
 
         ttk.Button(frame, text="Add to Cart", command=self.add_selected_to_cart).pack(
             pady=10
@@ -335,6 +649,7 @@ class ShoppingClient:
         for col in columns:
             self.cart_tree.heading(col, text=col.capitalize())
         self.cart_tree.pack(fill=tk.BOTH, expand=True)
+        self.cart_rows = TreeIndex(self.cart_tree)
 
         self.total_label = ttk.Label(frame, text="Total: ₹0.00", font=("Arial", 12))
         self.total_label.pack(pady=5)
@@ -361,11 +676,33 @@ class ShoppingClient:
         ttk.Label(frame, text="Order History", font=("Arial", 16)).pack(pady=10)
 
         columns = ("order_id", "product_id", "product_name", "quantity", "order_time")
-        self.history_tree = ttk.Treeview(frame, columns=columns, show="headings")
+        self.history_tree = ttk.Treeview(
+            frame, columns=columns, show="tree headings"
+        )
+        self.history_tree.column("#0", width=30, stretch=False)
         for col in columns:
             self.history_tree.heading(col, text=col.replace("_", " ").capitalize())
         self.history_tree.pack(fill=tk.BOTH, expand=True)
 
+        self.history_more_button = ttk.Button(
+            frame, text="Load More", command=self.load_more_history
+        )
+        self.history_more_button.pack(pady=10)
+        self.history_cursor = None
+
+    def setup_stats_frame(self):
+        frame = ttk.Frame(self.stats_frame, padding=20)
+        frame.pack(fill=tk.BOTH, expand=True)
+
+        ttk.Label(frame, text="Sales Stats", font=("Arial", 16)).pack(pady=10)
+        ttk.Button(frame, text="Refresh", command=self.load_stats).pack(pady=5)
+
+        columns = ("product_id", "name", "units_today", "units", "revenue")
+        self.stats_tree = ttk.Treeview(frame, columns=columns, show="headings")
+        for col in columns:
+            self.stats_tree.heading(col, text=col.replace("_", " ").capitalize())
+        self.stats_tree.pack(fill=tk.BOTH, expand=True)
+
     def handle_login(self):
         username = self.login_username.get()
         password = self.login_password.get()
@@ -378,10 +715,16 @@ class ShoppingClient:
 
         if response["status"] == "success":
             self.username = username
+            self.session_token = response.get("session_token")
+            self.catalog_version = response.get("catalog_version")
             self.notebook.tab(2, state="normal")
             self.notebook.tab(3, state="normal")
             self.notebook.tab(4, state="normal")
+            if response.get("is_admin"):
+                self.notebook.tab(5, state="normal")
+                self.load_stats()
             self.load_products()
+            self.load_cart()
             self.load_history()
             self.notebook.select(2)
         else:
@@ -406,43 +749,79 @@ class ShoppingClient:
         else:
             messagebox.showerror("Error", response.get("message", "Unknown error"))
 
+    def search_products(self):
+        self.product_offset = 0
+        self.load_products()
+
+    def change_product_page(self, step):
+        offset = self.product_offset + step * PRODUCT_PAGE_SIZE
+        if 0 <= offset < max(self.product_total, 1):
+            self.product_offset = offset
+            self.load_products()
+
     def load_products(self):
-        response = self.send_and_receive({"action": "get_products"})
+        request = {
+            "action": "search_products",
+            "query": self.search_var.get().strip(),
+            "in_stock": self.in_stock_var.get(),
+            "sort": self.sort_var.get(),
+            "offset": self.product_offset,
+            "limit": PRODUCT_PAGE_SIZE,
+        }
+        try:
+            if self.min_price_var.get().strip():
+                request["min_price_cents"] = parse_price(self.min_price_var.get())
+            if self.max_price_var.get().strip():
+                request["max_price_cents"] = parse_price(self.max_price_var.get())
+        except ValueError:
+            messagebox.showerror("Error", "Price filter must be a number")
+            return
+
+        response = self.send_and_receive(request)
         if not response:
             return
         if response["status"] == "success":
             server_products = response["products"]
+            self.product_total = response["total"]
+            first = self.product_offset + 1 if self.product_total else 0
+            last = min(self.product_offset + PRODUCT_PAGE_SIZE, self.product_total)
+            self.page_label.config(text=f"{first}-{last} of {self.product_total}")
             recent_broadcast = (
                 hasattr(self, "last_stock_update_time")
                 and (time.time() - self.last_stock_update_time) < 5
             )
             if recent_broadcast:
                 for server_product in server_products:
-                    for local_product in self.products:
-                        if local_product["id"] == server_product["id"]:
-                            if local_product["stock"] != server_product["stock"]:
-                                print(
-                                    f"Stock discrepancy for {server_product['name']}: "
-                                    f"Server:{server_product['stock']} Local:{local_product['stock']}"
-                                )
-                                server_product["stock"] = local_product["stock"]
-
+                    local_product = self.products_by_id.get(server_product["id"])
+                    if local_product is None:
+                        continue
+                    if local_product["stock"] != server_product["stock"]:
+                        print(
+                            f"Stock discrepancy for {server_product['name']}: "
+                            f"Server:{server_product['stock']} Local:{local_product['stock']}"
+                        )
+                        server_product["stock"] = local_product["stock"]
+
+            started = time.perf_counter()
             self.products = server_products
-
-            for i in self.products_tree.get_children():
-                self.products_tree.delete(i)
-
-            for product in self.products:
-                self.products_tree.insert(
-                    "",
-                    "end",
-                    values=(
+            self.products_by_id = {
+                product["id"]: product for product in self.products
+            }
+            self.products_rows.render(
+                [
+                    (
                         product["id"],
-                        product["name"],
-                        product["price"],
-                        product["stock"],
-                    ),
-                )
+                        (
+                            product["id"],
+                            product["name"],
+                            format_price(product["price_cents"]),
+                            product["stock"],
+                        ),
+                    )
+                    for product in self.products
+                ]
+            )
+            self.record_ui_time("load_products", started)
 
             self.status_var.set(
                 f"Connected to {self.server_host}:{self.server_port} - Products refreshed"
@@ -465,40 +844,83 @@ class ShoppingClient:
         )
         if quantity is None:
             return
-        self.cart.append(
-            {"id": product_id, "name": name, "price": price, "quantity": quantity}
+        response = self.send_and_receive(
+            {
+                "action": "cart_add",
+                "username": self.username,
+                "product_id": product_id,
+                "quantity": quantity,
+            }
         )
+        if not response:
+            return
+        if response["status"] != "success":
+            messagebox.showerror("Error", response.get("message", "Unknown error"))
+        else:
+            # Any change to the cart starts a new checkout key
+            self.checkout_key = None
+        self.cart = response.get("cart", self.cart)
         self.update_cart_view()
 
+    def load_cart(self):
+        response = self.send_and_receive(
+            {"action": "cart_get", "username": self.username}
+        )
+        if not response:
+            return
+        if response["status"] == "success":
+            self.cart = response["cart"]
+            self.update_cart_view()
+
     def update_cart_view(self):
-        for i in self.cart_tree.get_children():
-            self.cart_tree.delete(i)
-        total = 0.0
+        started = time.perf_counter()
+        rows = []
+        total_cents = 0
         for item in self.cart:
-            price = float(item["price"])
-            quantity = int(item["quantity"])
-            total += price * quantity
-            self.cart_tree.insert(
-                "", "end", values=(item["id"], item["name"], quantity, f"₹{price:.2f}")
+            price_cents = item["price_cents"]
+            quantity = item["quantity"]
+            total_cents += price_cents * quantity
+            rows.append(
+                (
+                    item["id"],
+                    (item["id"], item["name"], quantity, format_price(price_cents)),
+                )
             )
-        self.total_label.config(text=f"Total: ₹{total:.2f}")
+        self.cart_rows.render(rows)
+
+        # Amounts are integer paise, so the sum is exact
+        self.cart_total_cents = total_cents
+        self.total_label.config(text=f"Total: {format_price(self.cart_total_cents)}")
+        self.record_ui_time("update_cart_view", started)
 
     def handle_checkout(self):
         if not self.cart:
             messagebox.showinfo("Empty Cart", "Your cart is empty!")
             return
 
+        # The key survives timeouts so a retried checkout is never applied
+        # twice; any change to the cart starts a new key.
+        if self.checkout_key is None:
+            self.checkout_key = uuid.uuid4().hex
+
         response = self.send_and_receive(
-            {"action": "checkout", "username": self.username, "cart": self.cart}
+            {
+                "action": "checkout",
+                "username": self.username,
+                "idempotency_key": self.checkout_key,
+            },
+            retries=2,
         )
 
         if not response:
             return
 
+        self.checkout_key = None
         if response["status"] == "success":
-            messagebox.showinfo(
-                "Thank You!", "Your order has been placed successfully!"
-            )
+            message = "Your order has been placed successfully!"
+            if response.get("total_cents") is not None:
+                message += f"\nTotal charged: {format_price(response['total_cents'])}"
+            messagebox.showinfo("Thank You!", message)
             self.cart.clear()
             self.update_cart_view()
             self.load_products()
@@ -516,39 +938,119 @@ class ShoppingClient:
         item_values = self.cart_tree.item(selected)["values"]
         product_id = item_values[0]
 
-        self.cart = [item for item in self.cart if item["id"] != product_id]
+        response = self.send_and_receive(
+            {
+                "action": "cart_remove",
+                "username": self.username,
+                "product_id": product_id,
+            }
+        )
+        if not response:
+            return
+        if response.get("status") != "success":
+            messagebox.showerror("Error", response.get("message", "Remove failed"))
+            return
+        self.checkout_key = None
+        self.cart = response["cart"]
         self.update_cart_view()
 
     def clear_cart(self):
         if messagebox.askyesno(
             "Clear Cart", "Are you sure you want to clear your entire cart?"
         ):
-            self.cart.clear()
+            response = self.send_and_receive({"action": "cart_clear"})
+            if not response:
+                return
+            if response.get("status") != "success":
+                messagebox.showerror("Error", response.get("message", "Clear failed"))
+                return
+            self.checkout_key = None
+            self.cart = response["cart"]
             self.update_cart_view()
 
     def load_history(self):
-        response = self.send_and_receive(
-            {"action": "get_history", "username": self.username}
-        )
+        for i in self.history_tree.get_children():
+            self.history_tree.delete(i)
+        self.history_cursor = None
+        self.fetch_history_page()
+
+    def load_more_history(self):
+        if self.history_cursor is not None:
+            self.fetch_history_page()
+
+    def fetch_history_page(self):
+        request = {"action": "get_history", "username": self.username}
+        if self.history_cursor is not None:
+            request["before_id"] = self.history_cursor
+        response = self.send_and_receive(request)
 
         if not response:
             return
 
         if response["status"] == "success":
-            for i in self.history_tree.get_children():
-                self.history_tree.delete(i)
+            if self.history_cursor is None and response["orders"]:
+                self.newest_order_id = response["orders"][0]["id"]
             for order in response["orders"]:
-                self.history_tree.insert(
+                self.insert_history_order(order, "end")
+
+            self.history_cursor = response.get("next_cursor")
+            self.history_more_button.config(
+                state="normal" if self.history_cursor is not None else "disabled"
+            )
+
+    def insert_history_order(self, order, position):
+        parent = self.history_tree.insert(
+            "",
+            position,
+            values=(
+                order["id"],
+                "",
+                f"{len(order['items'])} item(s)"
+                + (
+                    f", {format_price(order['total_cents'])}"
+                    if order.get("total_cents") is not None
+                    else ""
+                ),
+                sum(item["quantity"] for item in order["items"]),
+                order["order_time"],
+            ),
+        )
+        for item in order["items"]:
+            self.history_tree.insert(
+                parent,
+                "end",
+                values=(
+                    "",
+                    item["product_id"],
+                    item["product_name"],
+                    item["quantity"],
+                    "",
+                ),
+            )
+
+    def load_stats(self):
+        response = self.send_and_receive({"action": "get_stats"})
+
+        if not response:
+            return
+
+        if response["status"] == "success":
+            for i in self.stats_tree.get_children():
+                self.stats_tree.delete(i)
+            for product in response["products"]:
+                self.stats_tree.insert(
                     "",
                     "end",
                     values=(
-                        order["id"],
-                        order["product_id"],
-                        order["product_name"],
-                        order["quantity"],
-                        order["order_time"],
+                        product["product_id"],
+                        product["name"],
+                        product["units_today"],
+                        product["units"],
+                        format_price(product["revenue_cents"]),
                     ),
                 )
+        else:
+            messagebox.showerror("Error", response.get("message", "Unknown error"))
 
     def show_reconnect_prompt(self):
         if not self.connected:
@@ -574,25 +1076,8 @@ class ShoppingClient:
                     self.client.connect((self.server_host, self.server_port))
                     self.connected = True
 
-                    self.listener_thread = threading.Thread(
-                        target=self.listen_for_broadcasts, daemon=True
-                    )
-                    self.listener_thread.start()
-
                     popup.destroy()
-                    messagebox.showinfo(
-                        "Reconnected", "Connection re-established. Please log in again."
-                    )
-
-                    self.username = None
-                    self.cart = []
-                    self.notebook.select(self.login_frame)
-                    self.notebook.tab(2, state="disabled")
-                    self.notebook.tab(3, state="disabled")
-                    self.notebook.tab(4, state="disabled")
-                    self.status_var.set(
-                        f"Connected to {self.server_host}:{self.server_port}"
-                    )
+                    self.on_reconnected()
                 except Exception as e:
                     messagebox.showerror(
                         "Reconnect Failed", f"Could not reconnect:\n{e}"
@@ -619,6 +1104,12 @@ class ShoppingClient:
 
     def on_closing(self):
         """Handle window closing event"""
+        self.closing = True
+        for name, (count, total, worst) in sorted(self.ui_timings.items()):
+            print(
+                f"[UI] {name}: {count} calls, avg {total / count * 1000:.2f} ms, "
+                f"max {worst * 1000:.2f} ms"
+            )
         if self.connected:
             try:
                 self.connected = False
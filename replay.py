@@ -0,0 +1,210 @@
+import argparse
+import json
+import socket
+import threading
+import time
+import uuid
+
+import capture
+from transport import MessageReader
+
+# Messages the server pushes without being asked; they are not responses
+PUSH_ACTIONS = ("stock_update", "server_restarting")
+
+EPILOG = """
+The target database should match the one the capture was taken from when
+capture started: the same users and products, with enough stock. Start from
+a fresh copy for every run; re-registering existing users, for example,
+only measures the error path. Checkout idempotency keys are prefixed per
+run so orders are really placed again, and session tokens are mapped to the
+ones the replayed logins return. With --max-rate, a resume may overtake the
+login that issued its token and fail.
+"""
+
+
+def load_connections(path):
+    """Group capture records by connection, ordered by first activity."""
+    connections = {}
+    for timestamp, connection_id, kind, payload in capture.read_capture(path):
+        connections.setdefault(connection_id, []).append(
+            (timestamp, kind, bytes(payload))
+        )
+    return sorted(connections.values(), key=lambda records: records[0][0])
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Replay:
+    def __init__(self, host, port, speed, key_prefix):
+        self.host = host
+        self.port = port
+        self.key_prefix = key_prefix
+        # Digest of a captured session token -> token issued to the replayed login
+        self.tokens = {}
+        # 0 means send every request as soon as the previous one is answered
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = 0
+        self.failed_connections = 0
+        self.base = None
+        self.started = None
+
+    def rewrite(self, request):
+        """Make a captured request valid against this run's server state."""
+        for field in ("idempotency_key", "checkout_key"):
+            if request.get(field):
+                request[field] = f"{self.key_prefix}-{request[field]}"
+        token = request.get("session_token")
+        if token:
+            # The capture holds digests of tokens, never the tokens themselves
+            with self.lock:
+                request["session_token"] = self.tokens.get(token, token)
+        return json.dumps(request, separators=(",", ":")).encode("utf-8")
+
+    def wait_until(self, timestamp):
+        if not self.speed:
+            return
+        due = self.started + (timestamp - self.base) / 1e9 / self.speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def play_connection(self, records):
+        try:
+            sock = socket.create_connection((self.host, self.port))
+        except OSError as e:
+            print(f"[REPLAY] Connect failed: {e}")
+            with self.lock:
+                self.failed_connections += 1
+            return
+
+        # Responses such as get_products can exceed the request size limit
+        reader = MessageReader(sock, max_size=None)
+        issued_token = None
+        try:
+            for timestamp, kind, payload in records:
+                if kind == capture.SESSION:
+                    if issued_token:
+                        with self.lock:
+                            self.tokens[payload.decode("ascii")] = issued_token
+                    continue
+                self.wait_until(timestamp)
+                if kind == capture.CLOSE:
+                    break
+                if kind != capture.REQUEST:
+                    continue
+
+                try:
+                    request = json.loads(payload)
+                    action = request.get("action")
+                    payload = self.rewrite(request)
+                except (ValueError, AttributeError):
+                    # Malformed requests are replayed too; the server rejects them
+                    action = None
+                start = time.perf_counter()
+                sock.sendall(payload + b"\n")
+                while True:
+                    data = reader.read()
+                    if data is None:
+                        raise ConnectionError("Server closed the connection")
+                    response = json.loads(data)
+                    if response.get("action") not in PUSH_ACTIONS:
+                        break
+                elapsed = time.perf_counter() - start
+                if action == "login":
+                    issued_token = response.get("session_token")
+
+                with self.lock:
+                    self.latencies.setdefault(action, []).append(elapsed)
+                    if response.get("status") == "error":
+                        self.errors += 1
+        except OSError as e:
+            print(f"[REPLAY] Connection dropped: {e}")
+            with self.lock:
+                self.failed_connections += 1
+        finally:
+            sock.close()
+
+    def run(self, connections):
+        self.base = connections[0][0][0]
+        self.started = time.perf_counter()
+        threads = []
+        for records in connections:
+            self.wait_until(records[0][0])
+            thread = threading.Thread(target=self.play_connection, args=(records,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - self.started
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a server --capture file against a running server",
+        epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("capture", help="Capture file written by server.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9998)
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Playback speed relative to the capture (2 = twice as fast)",
+    )
+    parser.add_argument(
+        "--max-rate",
+        action="store_true",
+        help="Ignore capture timing and send requests back to back",
+    )
+    parser.add_argument(
+        "--key-prefix",
+        default=uuid.uuid4().hex[:8],
+        help="Prefix for rewritten idempotency keys (random per run by default)",
+    )
+    args = parser.parse_args()
+
+    connections = load_connections(args.capture)
+    if not connections:
+        print("[REPLAY] Capture is empty")
+        return
+    requests = sum(
+        1
+        for records in connections
+        for _, kind, _ in records
+        if kind == capture.REQUEST
+    )
+    print(f"[REPLAY] {requests} requests over {len(connections)} connections")
+
+    replay = Replay(
+        args.host, args.port, 0 if args.max_rate else args.speed, args.key_prefix
+    )
+    elapsed = replay.run(connections)
+
+    completed = sum(len(values) for values in replay.latencies.values())
+    print(
+        f"[REPLAY] {completed} responses in {elapsed:.2f}s "
+        f"({completed / elapsed:.0f} req/s), {replay.errors} errors, "
+        f"{replay.failed_connections} failed connections"
+    )
+    by_action = sorted(replay.latencies.items(), key=lambda item: str(item[0]))
+    for action, values in by_action:
+        print(
+            f"[REPLAY] {str(action):<16} {len(values):7d}  "
+            f"p50 {percentile(values, 0.5) * 1000:8.2f} ms  "
+            f"p95 {percentile(values, 0.95) * 1000:8.2f} ms  "
+            f"p99 {percentile(values, 0.99) * 1000:8.2f} ms  "
+            f"max {max(values) * 1000:8.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
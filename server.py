@@ -1,14 +1,129 @@
+import os
+import random
+import signal
 import socket
+import subprocess
+import sys
 import threading
+import itertools
 import json
+import secrets
+import time
+import queue
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import mysql.connector
+import capture
+from catalog_index import CatalogIndex, SORT_KEYS
+from tracing import Tracer
+from transport import ClientWriter, MessageReader, encode_message
+
+PROCESS_START = time.monotonic()
+
+DB_USER = "shopping_user"
+DB_PASSWORD = "shopping_password"
+DB_NAME = "shopping_app"
+
+# Bump whenever migrate_schema() changes so existing databases pick it up;
+# otherwise boot skips the DDL entirely.
+SCHEMA_VERSION = 3
+
+# Idle database connections kept open between clients
+DB_POOL_SIZE = 8
+idle_connections = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+# Fraction of requests traced, and how many of the slowest traces to keep
+TRACE_SAMPLE_RATE = 0.0
+TRACE_KEEP = 50
+tracer = Tracer(TRACE_KEEP, TRACE_SAMPLE_RATE)
+
+# Set once the pool and in-memory caches are warm; see warm_up(). Failed
+# warm-ups are retried with backoff; requests give up after READY_TIMEOUT.
+WARMUP_RETRY_DELAY = 1
+WARMUP_MAX_RETRY_DELAY = 30
+READY_TIMEOUT = 30
+ready = threading.Event()
+first_request_served = threading.Event()
+
+
+def connect_db():
+    return mysql.connector.connect(user=DB_USER, password=DB_PASSWORD, database=DB_NAME)
+
+
+def acquire_connection():
+    while True:
+        try:
+            conn = idle_connections.get_nowait()
+        except queue.Empty:
+            return connect_db()
+        if conn.is_connected():
+            return conn
+
+
+def release_connection(conn):
+    try:
+        conn.rollback()
+        idle_connections.put_nowait(conn)
+    except (queue.Full, mysql.connector.Error):
+        conn.close()
+
+
+def column_exists(cursor, table, column):
+    cursor.execute(
+        """
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+        """,
+        (table, column),
+    )
+    return cursor.fetchone()[0] > 0
+
+
+def index_exists(cursor, table, index):
+    cursor.execute(
+        """
+        SELECT COUNT(*) FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+        """,
+        (table, index),
+    )
+    return cursor.fetchone()[0] > 0
 
 
 def init_db():
-    conn = mysql.connector.connect(user="shopping_user", password="shopping_password")
+    """Apply schema migrations, but only if the stored version is out of date."""
+    conn = mysql.connector.connect(user=DB_USER, password=DB_PASSWORD)
     cursor = conn.cursor()
-    cursor.execute("CREATE DATABASE IF NOT EXISTS shopping_app")
-    cursor.execute("USE shopping_app")
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS {DB_NAME}")
+    cursor.execute(f"USE {DB_NAME}")
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version INT NOT NULL)")
+
+    # Serialize migrations between processes, e.g. during a SIGHUP handoff
+    cursor.execute("SELECT GET_LOCK('shopping_app_schema', 60)")
+    if cursor.fetchone()[0] != 1:
+        cursor.close()
+        conn.close()
+        raise RuntimeError("Timed out waiting for the schema migration lock")
+    try:
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+        current = cursor.fetchone()[0]
+        if current != SCHEMA_VERSION:
+            print(f"[SERVER] Migrating schema {current} -> {SCHEMA_VERSION}")
+            migrate_schema(cursor)
+            cursor.execute("DELETE FROM schema_version")
+            cursor.execute(
+                "INSERT INTO schema_version (version) VALUES (%s)", (SCHEMA_VERSION,)
+            )
+            conn.commit()
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK('shopping_app_schema')")
+        cursor.fetchone()
+        cursor.close()
+        conn.close()
+
+
+def migrate_schema(cursor):
 
     # Create users table
     cursor.execute(
@@ -16,23 +131,56 @@ def init_db():
         CREATE TABLE IF NOT EXISTS users (
             id INT AUTO_INCREMENT PRIMARY KEY,
             username VARCHAR(255) UNIQUE,
-            password VARCHAR(255)
+            password VARCHAR(255),
+            is_admin BOOLEAN NOT NULL DEFAULT FALSE
         )
         """
     )
 
+    if not column_exists(cursor, "users", "is_admin"):
+        cursor.execute(
+            "ALTER TABLE users ADD COLUMN is_admin BOOLEAN NOT NULL DEFAULT FALSE"
+        )
+
     # Create products table
     cursor.execute(
         """
         CREATE TABLE IF NOT EXISTS products (
             id INT AUTO_INCREMENT PRIMARY KEY,
             name VARCHAR(255),
-            price FLOAT,
+            price_cents INT NOT NULL,
             stock INT
         )
         """
     )
 
+    # Prices used to be FLOAT rupees; convert them to exact integer paise
+    if not column_exists(cursor, "products", "price_cents"):
+        cursor.execute(
+            "ALTER TABLE products ADD COLUMN price_cents INT NOT NULL DEFAULT 0"
+        )
+        cursor.execute("UPDATE products SET price_cents = ROUND(price * 100)")
+        cursor.execute("ALTER TABLE products DROP COLUMN price")
+
+    # Lets reconnecting clients fetch only the products changed while offline
+    if not column_exists(cursor, "products", "updated_at"):
+        cursor.execute(
+            """
+            ALTER TABLE products
+            ADD COLUMN updated_at TIMESTAMP(6) NOT NULL
+                DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+            ADD KEY idx_products_updated (updated_at)
+            """
+        )
+
+    # Range filters and sorts used by search_products
+    if not index_exists(cursor, "products", "idx_products_price_cents"):
+        cursor.execute(
+            "CREATE INDEX idx_products_price_cents ON products (price_cents)"
+        )
+    if not index_exists(cursor, "products", "idx_products_stock"):
+        cursor.execute("CREATE INDEX idx_products_stock ON products (stock)")
+
     # Create orders table with the order_time field
     cursor.execute(
         """
@@ -42,80 +190,930 @@ def init_db():
             product_id INT,
             quantity INT,
             order_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+            idempotency_key VARCHAR(64) NULL,
             FOREIGN KEY (user_id) REFERENCES users(id),
             FOREIGN KEY (product_id) REFERENCES products(id)
         )
         """
     )
 
+    # Older databases predate checkout idempotency keys
+    if not column_exists(cursor, "orders", "idempotency_key"):
+        cursor.execute("ALTER TABLE orders ADD COLUMN idempotency_key VARCHAR(64) NULL")
+
+    # Nothing writes to orders any more, so its idempotency index is dead weight
+    if index_exists(cursor, "orders", "uniq_order_idempotency"):
+        cursor.execute("ALTER TABLE orders DROP INDEX uniq_order_idempotency")
+
+    # One header per purchase, with its lines in a child table. The per-line
+    # orders table above is kept only as the source for migrating old data.
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS order_headers (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            order_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+            idempotency_key VARCHAR(64) NULL,
+            total_cents BIGINT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            UNIQUE KEY uniq_header_idempotency (user_id, idempotency_key),
+            KEY idx_headers_user (user_id, id)
+        )
+        """
+    )
+
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS order_lines (
+            order_id INT NOT NULL,
+            product_id INT NOT NULL,
+            quantity INT NOT NULL,
+            unit_price_cents INT NULL,
+            PRIMARY KEY (order_id, product_id),
+            FOREIGN KEY (order_id) REFERENCES order_headers(id),
+            FOREIGN KEY (product_id) REFERENCES products(id)
+        )
+        """
+    )
+
+    # Orders placed before prices were recorded at checkout keep NULL totals
+    if not column_exists(cursor, "order_headers", "total_cents"):
+        cursor.execute("ALTER TABLE order_headers ADD COLUMN total_cents BIGINT NULL")
+    if not column_exists(cursor, "order_lines", "unit_price_cents"):
+        cursor.execute(
+            "ALTER TABLE order_lines ADD COLUMN unit_price_cents INT NULL"
+        )
+
+    # Group legacy per-line orders into purchases by (user, time, key)
+    cursor.execute("SELECT COUNT(*) FROM order_headers")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(
+            """
+            INSERT INTO order_headers (user_id, order_time, idempotency_key)
+            SELECT user_id, order_time, idempotency_key
+            FROM orders
+            GROUP BY user_id, order_time, idempotency_key
+            ORDER BY MIN(id)
+            """
+        )
+        cursor.execute(
+            """
+            INSERT INTO order_lines (order_id, product_id, quantity)
+            SELECT order_headers.id, orders.product_id, SUM(orders.quantity)
+            FROM orders
+            JOIN order_headers
+                ON order_headers.user_id = orders.user_id
+                AND order_headers.order_time = orders.order_time
+                AND order_headers.idempotency_key <=> orders.idempotency_key
+            GROUP BY order_headers.id, orders.product_id
+            """
+        )
+
     # Insert some sample products if the table is empty
     cursor.execute("SELECT COUNT(*) FROM products")
     if cursor.fetchone()[0] == 0:
         cursor.execute(
-            "INSERT INTO products (name, price, stock) VALUES ('Apple (1 kg)', 250, 100), ('Banana (1 kg)', 30, 150), ('Strawberry (200 gms)', 110, 150), ('Peach (500 gms)', 96, 150), ('Mango (1 kg)', 105, 150), ('Orange (1 kg)', 190, 150), ('Pineapple (1 pc)', 70, 150), ('Watermelon (1 pc)', 35, 150), ('Papaya (1 pc)', 70, 150)"
+            "INSERT INTO products (name, price_cents, stock) VALUES ('Apple (1 kg)', 25000, 100), ('Banana (1 kg)', 3000, 150), ('Strawberry (200 gms)', 11000, 150), ('Peach (500 gms)', 9600, 150), ('Mango (1 kg)', 10500, 150), ('Orange (1 kg)', 19000, 150), ('Pineapple (1 pc)', 7000, 150), ('Watermelon (1 pc)', 3500, 150), ('Papaya (1 pc)', 7000, 150)"
         )
 
     cursor.execute("SELECT COUNT(*) FROM users")
     if cursor.fetchone()[0] == 0:
         cursor.execute(
-            "INSERT INTO users (id, username, password) VALUES (1, 'admin', '123456')"
+            "INSERT INTO users (id, username, password, is_admin) VALUES (1, 'admin', '123456', TRUE)"
+        )
+    cursor.execute("UPDATE users SET is_admin = TRUE WHERE username = 'admin'")
+
+    # Session tokens let a client resume after a reconnect, including across
+    # server restarts, without sending the password again
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            token CHAR(64) PRIMARY KEY,
+            user_id INT NOT NULL,
+            expires_at DATETIME NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            KEY idx_sessions_expiry (expires_at)
+        )
+        """
+    )
+
+    # Hourly sales aggregates, maintained by checkout and flushed periodically
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sales_stats (
+            hour_start DATETIME NOT NULL,
+            product_id INT NOT NULL,
+            units INT NOT NULL,
+            revenue_cents BIGINT NOT NULL,
+            PRIMARY KEY (hour_start, product_id),
+            FOREIGN KEY (product_id) REFERENCES products(id)
+        )
+        """
+    )
+
+    if not column_exists(cursor, "sales_stats", "revenue_cents"):
+        cursor.execute(
+            "ALTER TABLE sales_stats ADD COLUMN revenue_cents BIGINT NOT NULL DEFAULT 0"
+        )
+        cursor.execute("UPDATE sales_stats SET revenue_cents = ROUND(revenue * 100)")
+        cursor.execute("ALTER TABLE sales_stats DROP COLUMN revenue")
+
+    # Backfill from existing orders once. Lines from before prices were
+    # recorded fall back to the current product price as an estimate.
+    cursor.execute("SELECT COUNT(*) FROM sales_stats")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(
+            """
+            INSERT INTO sales_stats (hour_start, product_id, units, revenue_cents)
+            SELECT DATE_FORMAT(order_headers.order_time, '%Y-%m-%d %H:00:00'),
+                order_lines.product_id,
+                SUM(order_lines.quantity),
+                SUM(
+                    order_lines.quantity
+                    * COALESCE(order_lines.unit_price_cents, products.price_cents)
+                )
+            FROM order_lines
+            JOIN order_headers ON order_lines.order_id = order_headers.id
+            JOIN products ON order_lines.product_id = products.id
+            GROUP BY 1, 2
+            """
+        )
+
+    # Older servers flushed live sales on UTC hours; fold any such rows into
+    # the local-hour buckets the backfill and hour_start() use
+    cursor.execute(
+        """
+        INSERT INTO sales_stats (hour_start, product_id, units, revenue_cents)
+        SELECT DATE_FORMAT(hour_start, '%Y-%m-%d %H:00:00'), product_id,
+            SUM(units), SUM(revenue_cents)
+        FROM sales_stats
+        WHERE MINUTE(hour_start) <> 0 OR SECOND(hour_start) <> 0
+        GROUP BY 1, 2
+        ON DUPLICATE KEY UPDATE
+            units = units + VALUES(units),
+            revenue_cents = revenue_cents + VALUES(revenue_cents)
+        """
+    )
+    cursor.execute(
+        "DELETE FROM sales_stats WHERE MINUTE(hour_start) <> 0 OR SECOND(hour_start) <> 0"
+    )
+
+
+catalog = CatalogIndex()
+# The index is refreshed from products.updated_at, so restocks, price edits,
+# new products and checkouts made by another process (e.g. during a handoff)
+# show up within CATALOG_REFRESH_INTERVAL seconds. Rows are re-read with some
+# slack to catch transactions that committed after a later timestamp was seen.
+CATALOG_REFRESH_INTERVAL = 2
+CATALOG_REFRESH_SLACK = 5
+# Explicit product reads refresh first unless the index is younger than this
+CATALOG_READ_MAX_AGE = 0.5
+catalog_seen_version = None
+catalog_refreshed_at = 0.0
+catalog_refresh_lock = threading.Lock()
+
+# get_products response, encoded once per catalog version and shared
+cached_catalog = (None, None)
+cached_catalog_lock = threading.Lock()
+
+
+def catalog_payload():
+    global cached_catalog
+    with cached_catalog_lock:
+        version, payload = cached_catalog
+        if version != catalog.version:
+            version, products = catalog.snapshot()
+            payload = encode_message({"status": "success", "products": products})
+            cached_catalog = (version, payload)
+        return payload
+
+
+def fetch_catalog_rows(cursor, since=None):
+    if since is None:
+        cursor.execute("SELECT id, name, price_cents, stock, updated_at FROM products")
+    else:
+        cursor.execute(
+            "SELECT id, name, price_cents, stock, updated_at FROM products WHERE updated_at >= %s - INTERVAL %s SECOND",
+            (since, CATALOG_REFRESH_SLACK),
+        )
+    products = cursor.fetchall()
+    for product in products:
+        product["stock"] = int(product["stock"])
+        product["version"] = format_version(product.pop("updated_at"))
+    return products
+
+
+def load_catalog():
+    global catalog_seen_version, catalog_refreshed_at
+    with catalog_refresh_lock:
+        catalog_refreshed_at = time.monotonic()
+        conn = acquire_connection()
+        cursor = conn.cursor(dictionary=True)
+        products = fetch_catalog_rows(cursor)
+        cursor.close()
+        release_connection(conn)
+        catalog.load(products)
+        catalog_seen_version = max(
+            (product["version"] for product in products), default=None
         )
 
-    conn.commit()
-    cursor.close()
-    conn.close()
 
+def refresh_catalog(max_age=0):
+    global catalog_seen_version, catalog_refreshed_at
+    with catalog_refresh_lock:
+        # Callers that queued behind another refresh can use its result
+        if time.monotonic() - catalog_refreshed_at < max_age:
+            return
+        catalog_refreshed_at = time.monotonic()
+        conn = acquire_connection()
+        cursor = conn.cursor(dictionary=True)
+        products = fetch_catalog_rows(cursor, catalog_seen_version)
+        cursor.close()
+        release_connection(conn)
+        applied = catalog.merge(products)
+        if applied:
+            print(f"[SERVER] Catalog refreshed, {applied} products changed")
+        versions = [product["version"] for product in products]
+        if catalog_seen_version is not None:
+            versions.append(catalog_seen_version)
+        catalog_seen_version = max(versions, default=None)
+
+
+def catalog_refresher():
+    ready.wait()
+    while True:
+        time.sleep(CATALOG_REFRESH_INTERVAL)
+        try:
+            refresh_catalog()
+        except Exception as e:
+            print(f"[CATALOG ERROR] {str(e)}")
 
-init_db()
 
 connected_clients = {}
 clients_lock = threading.Lock()
 
+# Set by --capture; records every request for replay.py
+capture_writer = None
+# Tagged with the pid so a handoff successor appending to the same capture
+# file never reuses its parent's ids
+connection_ids = itertools.count((os.getpid() << 32) + 1)
+
+# Sales aggregates kept up to date by checkout: lifetime totals per product
+# and hourly buckets for the recent window. Sales since the last flush are
+# added onto sales_stats every STATS_FLUSH_INTERVAL seconds; flushing deltas
+# rather than totals lets two processes (e.g. during a handoff) share a bucket.
+STATS_FLUSH_INTERVAL = 30
+STATS_RETENTION = 48 * 60 * 60
+
+product_sales = {}
+hourly_sales = {}
+pending_sales = {}
+stats_lock = threading.Lock()
+
+
+def hour_start(timestamp):
+    """Start of the local-time hour containing timestamp.
+
+    Buckets follow local hours, like the SQL backfill (which assumes MySQL's
+    session time zone matches this process), so every bucket falls on one
+    side of local midnight even under half-hour offsets such as IST.
+    """
+    local = time.localtime(timestamp)
+    return int(timestamp) - local.tm_min * 60 - local.tm_sec
+
+
+def load_sales_stats():
+    conn = acquire_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT product_id, SUM(units), SUM(revenue_cents) FROM sales_stats GROUP BY product_id"
+    )
+    totals = cursor.fetchall()
+    cursor.execute(
+        "SELECT UNIX_TIMESTAMP(hour_start), product_id, units, revenue_cents FROM sales_stats WHERE hour_start >= FROM_UNIXTIME(%s)",
+        (hour_start(time.time() - STATS_RETENTION),),
+    )
+    buckets = cursor.fetchall()
+    cursor.close()
+    release_connection(conn)
+
+    with stats_lock:
+        for product_id, units, revenue_cents in totals:
+            product_sales[product_id] = {
+                "units": int(units),
+                "revenue_cents": int(revenue_cents),
+            }
+        for bucket, product_id, units, revenue_cents in buckets:
+            hourly_sales.setdefault(int(bucket), {})[product_id] = {
+                "units": int(units),
+                "revenue_cents": int(revenue_cents),
+            }
+
+
+def record_sale(product_id, quantity, price_cents):
+    bucket = hour_start(time.time())
+    with stats_lock:
+        for entry in (
+            product_sales.setdefault(product_id, {"units": 0, "revenue_cents": 0}),
+            hourly_sales.setdefault(bucket, {}).setdefault(
+                product_id, {"units": 0, "revenue_cents": 0}
+            ),
+            pending_sales.setdefault(
+                (bucket, product_id), {"units": 0, "revenue_cents": 0}
+            ),
+        ):
+            entry["units"] += quantity
+            entry["revenue_cents"] += quantity * price_cents
+
+
+def flush_sales_stats():
+    global pending_sales
+    with stats_lock:
+        flushing = pending_sales
+        pending_sales = {}
+        rows = [
+            (bucket, product_id, entry["units"], entry["revenue_cents"])
+            for (bucket, product_id), entry in flushing.items()
+        ]
+
+        cutoff = hour_start(time.time() - STATS_RETENTION)
+        for bucket in [bucket for bucket in hourly_sales if bucket < cutoff]:
+            del hourly_sales[bucket]
+
+    if not rows:
+        return
+
+    conn = acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.executemany(
+            """
+            INSERT INTO sales_stats (hour_start, product_id, units, revenue_cents)
+            VALUES (FROM_UNIXTIME(%s), %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                units = units + VALUES(units),
+                revenue_cents = revenue_cents + VALUES(revenue_cents)
+            """,
+            rows,
+        )
+        conn.commit()
+    except Exception:
+        # Merge the deltas back so the next flush retries them
+        with stats_lock:
+            for key, entry in flushing.items():
+                pending = pending_sales.setdefault(
+                    key, {"units": 0, "revenue_cents": 0}
+                )
+                pending["units"] += entry["units"]
+                pending["revenue_cents"] += entry["revenue_cents"]
+        raise
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+
+def stats_flusher():
+    while True:
+        time.sleep(STATS_FLUSH_INTERVAL)
+        try:
+            flush_sales_stats()
+        except Exception as e:
+            print(f"[STATS ERROR] {str(e)}")
+
+
+def sales_snapshot():
+    """Per-product totals, today's units and the last 24 hourly buckets.
+
+    Cost depends only on the number of products and retained buckets, never
+    on order volume.
+    """
+    now = time.time()
+    local = time.localtime(now)
+    midnight = int(now) - (local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec)
+    with stats_lock:
+        today = {}
+        hours = []
+        for bucket, products in sorted(hourly_sales.items()):
+            if bucket >= hour_start(now - 24 * 3600):
+                hours.append(
+                    {
+                        "hour_start": bucket,
+                        "units": sum(entry["units"] for entry in products.values()),
+                        "revenue_cents": sum(
+                            entry["revenue_cents"] for entry in products.values()
+                        ),
+                    }
+                )
+            if bucket >= midnight:
+                for product_id, entry in products.items():
+                    today[product_id] = today.get(product_id, 0) + entry["units"]
+        products = [
+            {
+                "product_id": product_id,
+                "units": entry["units"],
+                "revenue_cents": entry["revenue_cents"],
+                "units_today": today.get(product_id, 0),
+            }
+            for product_id, entry in product_sales.items()
+        ]
+    return products, hours
+
+# Server-held carts, keyed by username. A cart is evicted after CART_TTL
+# seconds without activity; while it is fresh (STOCK_HOLD_TTL) its items
+# count as a soft hold against the stock other users can add to their carts.
+CART_TTL = 30 * 60
+STOCK_HOLD_TTL = 5 * 60
+
+# Both orders follow the last touch, so expired entries are always at the
+# front. held_quantities sums the items of every cart with an active hold.
+carts = OrderedDict()
+holding_carts = OrderedDict()
+held_quantities = {}
+carts_lock = threading.Lock()
+
+HISTORY_PAGE_SIZE = 20
+
+
+def adjust_hold(product_id, delta):
+    held = held_quantities.get(product_id, 0) + delta
+    if held:
+        held_quantities[product_id] = held
+    else:
+        held_quantities.pop(product_id, None)
+
+
+def release_hold(username):
+    if holding_carts.pop(username, None) is None:
+        return
+    for product_id, item in carts[username]["items"].items():
+        adjust_hold(product_id, -item["quantity"])
+
+
+def evict_expired_carts(now):
+    while holding_carts:
+        username = next(iter(holding_carts))
+        if carts[username]["hold_until"] > now:
+            break
+        release_hold(username)
+    while carts:
+        username, cart = next(iter(carts.items()))
+        if cart["expires_at"] > now:
+            break
+        release_hold(username)
+        del carts[username]
 
-def broadcast_stock_update(product_id, new_stock):
+
+def touch_cart(username, now):
+    cart = carts.get(username)
+    if cart is None:
+        cart = {"items": {}}
+        carts[username] = cart
+    carts.move_to_end(username)
+    cart["expires_at"] = now + CART_TTL
+    cart["hold_until"] = now + STOCK_HOLD_TTL
+    if username in holding_carts:
+        holding_carts.move_to_end(username)
+    else:
+        holding_carts[username] = True
+        for product_id, item in cart["items"].items():
+            adjust_hold(product_id, item["quantity"])
+    return cart
+
+
+def held_stock(product_id, cart):
+    """Quantity of product_id held by carts other than cart (which must be held)."""
+    item = cart["items"].get(product_id)
+    return held_quantities.get(product_id, 0) - (item["quantity"] if item else 0)
+
+
+def cart_items(username):
+    cart = carts.get(username)
+    if cart is None:
+        return []
+    return [dict(item) for item in cart["items"].values()]
+
+
+def cart_add(username, product, quantity):
+    """Add quantity of product to the user's cart, honouring other users' holds.
+
+    Returns an error message, or None if the item was added.
+    """
+    if quantity <= 0:
+        return "Quantity must be positive"
+    with carts_lock:
+        now = time.monotonic()
+        evict_expired_carts(now)
+        cart = touch_cart(username, now)
+        product_id = product["id"]
+        item = cart["items"].get(product_id)
+        new_quantity = quantity + (item["quantity"] if item else 0)
+        available = int(product["stock"]) - held_stock(product_id, cart)
+        if new_quantity > available:
+            return f"Only {max(available, 0)} of {product['name']} available"
+        adjust_hold(product_id, quantity)
+        cart["items"][product_id] = {
+            "id": product_id,
+            "name": product["name"],
+            "price_cents": int(product["price_cents"]),
+            "quantity": new_quantity,
+        }
+    return None
+
+
+def cart_remove(username, product_id, quantity=None):
+    with carts_lock:
+        now = time.monotonic()
+        evict_expired_carts(now)
+        cart = touch_cart(username, now)
+        item = cart["items"].get(product_id)
+        if item is None:
+            return
+        if quantity is None or quantity >= item["quantity"]:
+            adjust_hold(product_id, -item["quantity"])
+            del cart["items"][product_id]
+        else:
+            adjust_hold(product_id, -quantity)
+            item["quantity"] -= quantity
+
+
+def clear_cart(username):
+    with carts_lock:
+        if username in carts:
+            release_hold(username)
+            del carts[username]
+
+
+# Outcomes of recent checkouts, keyed by (username, idempotency key), so a
+# retried request gets the original response without touching stock again.
+# Bounded LRU with TTL; the unique key on order_headers covers anything evicted.
+IDEMPOTENCY_TTL = 24 * 60 * 60
+IDEMPOTENCY_CACHE_SIZE = 10000
+
+checkout_results = OrderedDict()
+checkout_results_lock = threading.Lock()
+
+
+def get_checkout_result(username, key):
+    with checkout_results_lock:
+        entry = checkout_results.get((username, key))
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if expires_at <= time.monotonic():
+            del checkout_results[(username, key)]
+            return None
+        checkout_results.move_to_end((username, key))
+        return response
+
+
+def store_checkout_result(username, key, response):
+    with checkout_results_lock:
+        checkout_results[(username, key)] = (
+            time.monotonic() + IDEMPOTENCY_TTL,
+            response,
+        )
+        checkout_results.move_to_end((username, key))
+        while len(checkout_results) > IDEMPOTENCY_CACHE_SIZE:
+            checkout_results.popitem(last=False)
+
+
+def send_checkout_result(writer, username, key, response):
+    if key:
+        response["idempotency_key"] = key
+        store_checkout_result(username, key, response)
+    send(writer, response)
+
+
+SESSION_TTL_HOURS = 12
+# Resume re-sends products changed slightly before the client's version so a
+# transaction that committed late with an earlier timestamp is not missed.
+RESUME_VERSION_SLACK = 5
+
+# Resume requests per second, to size the reconnect storm after a restart
+reconnect_times = deque()
+reconnect_peak = 0
+reconnect_lock = threading.Lock()
+
+
+def format_version(updated_at):
+    return updated_at.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def catalog_version(cursor):
+    cursor.execute("SELECT MAX(updated_at) AS version FROM products")
+    version = cursor.fetchone()["version"]
+    return format_version(version) if version else None
+
+
+def record_reconnect():
+    global reconnect_peak
+    now = time.monotonic()
+    with reconnect_lock:
+        reconnect_times.append(now)
+        while reconnect_times and reconnect_times[0] < now - 60:
+            reconnect_times.popleft()
+        last_second = sum(1 for t in reconnect_times if t >= now - 1)
+        if last_second > reconnect_peak:
+            reconnect_peak = last_second
+            print(f"[SERVER] Reconnect storm peak: {last_second} resumes/s")
+
+
+def reconnect_stats():
+    now = time.monotonic()
+    with reconnect_lock:
+        last_minute = sum(1 for t in reconnect_times if t >= now - 60)
+        return {"last_minute": last_minute, "peak_per_second": reconnect_peak}
+
+
+def attach_order_lines(cursor, headers):
+    """Build history entries for order headers, fetching all lines in one query."""
+    orders = []
+    orders_by_id = {}
+    for header in headers:
+        order = {
+            "id": header["id"],
+            "order_time": header["order_time"].isoformat(),
+            "total_cents": header["total_cents"],
+            "items": [],
+        }
+        orders.append(order)
+        orders_by_id[header["id"]] = order
+
+    if orders:
+        placeholders = ", ".join(["%s"] * len(orders))
+        cursor.execute(
+            f"""
+            SELECT order_lines.order_id, order_lines.product_id, order_lines.quantity, order_lines.unit_price_cents, products.name AS product_name
+            FROM order_lines
+            JOIN products ON order_lines.product_id = products.id
+            WHERE order_lines.order_id IN ({placeholders})
+            """,
+            list(orders_by_id),
+        )
+        for line in cursor.fetchall():
+            orders_by_id[line.pop("order_id")]["items"].append(line)
+    return orders
+
+
+def broadcast_stock_update(product_id, new_stock, version=None):
     update_message = {
         "action": "stock_update",
         "product_id": product_id,
         "new_stock": new_stock,
     }
+    if version is not None:
+        update_message["catalog_version"] = version
+
+    # Serialized once; every client's queue shares the same bytes
+    payload = encode_message(update_message)
 
     with clients_lock:
         disconnected_clients = []
-        for client_id, client_socket in connected_clients.items():
+        for client_id, writer in connected_clients.items():
             try:
-                send(client_socket, update_message)
-            except:
+                if not writer.write(payload, block=False):
+                    # Too far behind to keep up; it will resume on reconnect
+                    print(f"[SERVER] Dropping slow client {client_id}")
+                    writer.abort()
+                    disconnected_clients.append(client_id)
+            except OSError:
                 disconnected_clients.append(client_id)
 
         for client_id in disconnected_clients:
             del connected_clients[client_id]
 
 
+# Graceful shutdown: once shutting_down is set the accept loop stops, clients
+# are told to reconnect after a jittered delay, and in-flight requests get up
+# to DRAIN_TIMEOUT seconds to finish before their sockets are closed.
+DRAIN_TIMEOUT = 30
+RECONNECT_DELAY = 5
+RECONNECT_SPREAD = 10
+
+shutting_down = threading.Event()
+in_flight = 0
+in_flight_cond = threading.Condition()
+
+
+def begin_request():
+    global in_flight
+    with in_flight_cond:
+        in_flight += 1
+
+
+def end_request():
+    global in_flight
+    with in_flight_cond:
+        in_flight -= 1
+        if in_flight == 0:
+            in_flight_cond.notify_all()
+
+
+def notify_restart():
+    """Tell every client to reconnect later and stop reading new requests.
+
+    Each client gets its own random delay so reconnects are spread out
+    instead of arriving as one storm. Shutting down the read side makes idle
+    handlers return from recv(); busy ones finish their current request.
+    """
+    with clients_lock:
+        for writer in connected_clients.values():
+            try:
+                writer.write(
+                    encode_message(
+                        {
+                            "action": "server_restarting",
+                            "reconnect_delay": RECONNECT_DELAY
+                            + random.uniform(0, RECONNECT_SPREAD),
+                        }
+                    ),
+                    block=False,
+                )
+                writer.sock.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+
+
+def drain(deadline):
+    notify_restart()
+
+    with in_flight_cond:
+        while in_flight > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print(f"[SERVER] Drain deadline hit, {in_flight} request(s) running")
+                break
+            in_flight_cond.wait(remaining)
+
+    try:
+        flush_sales_stats()
+    except Exception as e:
+        print(f"[STATS ERROR] {str(e)}")
+
+    with clients_lock:
+        writers = list(connected_clients.values())
+    for writer in writers:
+        writer.close(max(0, deadline - time.monotonic()))
+        try:
+            writer.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def spawn_successor(server):
+    """Start a new server process that inherits the listening socket.
+
+    Connections arriving during the handoff wait in the shared accept backlog
+    instead of being refused. The successor gets this process's own options
+    (--capture, --trace-sample, ...) with --listen-fd replaced.
+    """
+    fd = server.fileno()
+    os.set_inheritable(fd, True)
+    args = []
+    skip = False
+    for arg in sys.argv[1:]:
+        if skip:
+            skip = False
+        elif arg == "--listen-fd":
+            skip = True
+        elif not arg.startswith("--listen-fd="):
+            args.append(arg)
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), *args, "--listen-fd", str(fd)],
+        pass_fds=(fd,),
+    )
+    print("[SERVER] Handed listening socket to a new process")
+
+
+# Touch the hot tables and indexes so first requests do not pay for cold pages
+WARMUP_QUERIES = (
+    "SELECT id, username, password, is_admin FROM users LIMIT 1000",
+    "SELECT COUNT(*) FROM order_headers",
+    "SELECT COUNT(*) FROM sessions WHERE expires_at > NOW()",
+)
+
+
+def warm_connection():
+    conn = connect_db()
+    cursor = conn.cursor()
+    for query in WARMUP_QUERIES:
+        cursor.execute(query)
+        cursor.fetchall()
+    cursor.close()
+    release_connection(conn)
+
+
+def warm_up():
+    """Fill the connection pool and in-memory caches in parallel, then go ready."""
+    started = time.monotonic()
+    delay = WARMUP_RETRY_DELAY
+    while not shutting_down.is_set():
+        try:
+            with ThreadPoolExecutor(max_workers=DB_POOL_SIZE + 2) as executor:
+                tasks = [
+                    executor.submit(load_catalog),
+                    executor.submit(load_sales_stats),
+                ]
+                tasks += [executor.submit(warm_connection) for _ in range(DB_POOL_SIZE)]
+                for task in tasks:
+                    task.result()
+            break
+        except Exception as e:
+            print(f"[SERVER] Warm-up failed: {str(e)}; retrying in {delay}s")
+            shutting_down.wait(delay)
+            delay = min(delay * 2, WARMUP_MAX_RETRY_DELAY)
+    else:
+        return
+    ready.set()
+    print(
+        f"[SERVER] Warm in {time.monotonic() - started:.2f}s, "
+        f"{time.monotonic() - PROCESS_START:.2f}s after start"
+    )
+
+
 def handle_client(client_socket, client_address):
     client_id = f"{client_address[0]}:{client_address[1]}"
 
+    # Get the database connection before anything that needs cleaning up
+    try:
+        conn = acquire_connection()
+    except Exception as e:
+        print(f"[ERROR] No database connection for {client_id}: {str(e)}")
+        client_socket.close()
+        return
+    cursor = conn.cursor(dictionary=True)
+
+    writer = ClientWriter(client_socket)
+    reader = MessageReader(client_socket)
+    connection_id = next(connection_ids)
+    if capture_writer is not None:
+        capture_writer.record(connection_id, capture.OPEN)
+
     with clients_lock:
-        connected_clients[client_id] = client_socket
+        connected_clients[client_id] = writer
 
     client_socket.settimeout(300)
 
-    conn = mysql.connector.connect(
-        user="shopping_user", password="shopping_password", database="shopping_app"
-    )
-    cursor = conn.cursor(dictionary=True)
+    session_user = None
+    busy = False
+    trace = None
 
     try:
         while True:
+            if busy:
+                tracer.finish(trace)
+                end_request()
+                busy = False
+            if shutting_down.is_set():
+                break
+
             try:
-                data = client_socket.recv(4096)
-                if not data:
+                data = reader.read()
+                if data is None:
                     print(f"[SERVER] Client {client_id} disconnected.")
                     break
+                if capture_writer is not None:
+                    capture_writer.record(
+                        connection_id, capture.REQUEST, capture.redact(data)
+                    )
+
+                begin_request()
+                busy = True
+                trace = tracer.start(client_id, reader.received_at)
+                trace.mark("recv")
 
                 request = json.loads(data.decode("utf-8"))
                 action = request.get("action")
+                trace.action = action
+                trace.mark("parse")
                 print(f"[SERVER] Received from {client_id}: {action}")
 
+                if action == "health":
+                    send(
+                        writer,
+                        {
+                            "status": "success",
+                            "ready": ready.is_set() and not shutting_down.is_set(),
+                            "draining": shutting_down.is_set(),
+                            "uptime": round(time.monotonic() - PROCESS_START, 3),
+                        },
+                    )
+                    continue
+
+                # Requests that reach a node still warming up wait for it
+                if not ready.wait(READY_TIMEOUT):
+                    send(
+                        writer,
+                        {"status": "error", "message": "Server is still starting up"},
+                    )
+                    continue
+                if not first_request_served.is_set():
+                    first_request_served.set()
+                    print(
+                        "[SERVER] First request "
+                        f"{time.monotonic() - PROCESS_START:.2f}s after start"
+                    )
+
                 if action == "register":
                     username = request["username"]
                     password = request["password"]
@@ -125,10 +1123,10 @@ def handle_client(client_socket, client_address):
                             (username, password),
                         )
                         conn.commit()
-                        send(client_socket, {"status": "success"})
+                        send(writer, {"status": "success"})
                     except mysql.connector.errors.IntegrityError:
                         send(
-                            client_socket,
+                            writer,
                             {"status": "error", "message": "Username already exists"},
                         )
 
@@ -139,53 +1137,384 @@ def handle_client(client_socket, client_address):
                         "SELECT * FROM users WHERE username=%s AND password=%s",
                         (username, password),
                     )
-                    if cursor.fetchone():
-                        send(client_socket, {"status": "success"})
+                    user = cursor.fetchone()
+                    if user:
+                        session_user = user
+                        token = secrets.token_hex(32)
+                        cursor.execute("DELETE FROM sessions WHERE expires_at < NOW()")
+                        cursor.execute(
+                            "INSERT INTO sessions (token, user_id, expires_at) VALUES (%s, %s, NOW() + INTERVAL %s HOUR)",
+                            (token, user["id"], SESSION_TTL_HOURS),
+                        )
+                        conn.commit()
+                        if capture_writer is not None:
+                            capture_writer.record(
+                                connection_id,
+                                capture.SESSION,
+                                capture.token_digest(token).encode("ascii"),
+                            )
+                        send(
+                            writer,
+                            {
+                                "status": "success",
+                                "is_admin": bool(user["is_admin"]),
+                                "session_token": token,
+                                "catalog_version": catalog_version(cursor),
+                            },
+                        )
                     else:
                         send(
-                            client_socket,
+                            writer,
                             {"status": "error", "message": "Invalid credentials"},
                         )
 
+                elif action == "resume":
+                    record_reconnect()
+                    conn.commit()
+                    cursor.execute(
+                        """
+                        SELECT users.* FROM sessions
+                        JOIN users ON sessions.user_id = users.id
+                        WHERE sessions.token = %s AND sessions.expires_at > NOW()
+                        """,
+                        (request.get("session_token"),),
+                    )
+                    user = cursor.fetchone()
+                    if not user:
+                        send(
+                            writer,
+                            {"status": "error", "message": "Session expired"},
+                        )
+                        continue
+                    session_user = user
+                    username = user["username"]
+
+                    # Products changed since the client's last known version
+                    version = request.get("catalog_version")
+                    if version:
+                        cursor.execute(
+                            """
+                            SELECT id, name, price_cents, stock FROM products
+                            WHERE updated_at >= %s - INTERVAL %s SECOND
+                            """,
+                            (version, RESUME_VERSION_SLACK),
+                        )
+                        changed_products = cursor.fetchall()
+                    else:
+                        changed_products = []
+
+                    # Orders placed after the newest one the client has seen,
+                    # e.g. a checkout whose response was lost in the disconnect
+                    cursor.execute(
+                        """
+                        SELECT id, order_time, total_cents FROM order_headers
+                        WHERE user_id = %s AND id > %s
+                        ORDER BY id DESC LIMIT %s
+                        """,
+                        (
+                            user["id"],
+                            request.get("after_order_id") or 0,
+                            HISTORY_PAGE_SIZE,
+                        ),
+                    )
+                    new_orders = attach_order_lines(cursor, cursor.fetchall())
+
+                    # A checkout whose response was lost may have committed and
+                    # cleared the cart; rebuilding it would invite a second order.
+                    checkout = None
+                    key = request.get("checkout_key")
+                    if key:
+                        checkout = get_checkout_result(username, key)
+                        if checkout is None:
+                            cursor.execute(
+                                "SELECT id, total_cents FROM order_headers WHERE user_id=%s AND idempotency_key=%s",
+                                (user["id"], key),
+                            )
+                            header = cursor.fetchone()
+                            if header:
+                                checkout = {
+                                    "status": "success",
+                                    "order_id": header["id"],
+                                    "total_cents": header["total_cents"],
+                                }
+                        if checkout is not None and checkout["status"] != "success":
+                            checkout = None
+
+                    # Server carts are memory-only; rebuild one lost in a
+                    # restart from the client's copy, re-checking stock holds.
+                    with carts_lock:
+                        has_cart = bool(cart_items(username))
+                    if not has_cart and checkout is None:
+                        for item in request.get("cart", []):
+                            cursor.execute(
+                                "SELECT id, name, price_cents, stock FROM products WHERE id=%s",
+                                (item["id"],),
+                            )
+                            product = cursor.fetchone()
+                            if product:
+                                cart_add(username, product, int(item["quantity"]))
+                    with carts_lock:
+                        items = cart_items(username)
+
+                    send(
+                        writer,
+                        {
+                            "status": "success",
+                            "username": username,
+                            "is_admin": bool(user["is_admin"]),
+                            "products": changed_products,
+                            "catalog_version": catalog_version(cursor),
+                            "orders": new_orders,
+                            "cart": items,
+                            "checkout": checkout,
+                        },
+                    )
+
                 elif action == "get_products":
+                    refresh_catalog(CATALOG_READ_MAX_AGE)
+                    writer.write(catalog_payload())
+
+                elif action == "cart_add":
+                    if not session_user:
+                        send(
+                            writer,
+                            {"status": "error", "message": "Login required"},
+                        )
+                        continue
+                    username = session_user["username"]
+                    product_id = request["product_id"]
+                    quantity = int(request["quantity"])
+                    if quantity <= 0:
+                        send(
+                            writer,
+                            {"status": "error", "message": "Quantity must be positive"},
+                        )
+                        continue
+
                     conn.commit()
-                    cursor.execute("SELECT * FROM products")
-                    products = cursor.fetchall()
-                    for product in products:
-                        product["price"] = float(product["price"])
-                        product["stock"] = int(product["stock"])
+                    cursor.execute(
+                        "SELECT id, name, price_cents, stock FROM products WHERE id=%s",
+                        (product_id,),
+                    )
+                    product = cursor.fetchone()
+                    if not product:
+                        send(
+                            writer,
+                            {"status": "error", "message": "Product not found"},
+                        )
+                        continue
+
+                    error = cart_add(username, product, quantity)
+                    with carts_lock:
+                        items = cart_items(username)
+                    if error:
+                        send(
+                            writer,
+                            {"status": "error", "message": error, "cart": items},
+                        )
+                    else:
+                        send(writer, {"status": "success", "cart": items})
+
+                elif action == "cart_remove":
+                    if not session_user:
+                        send(
+                            writer,
+                            {"status": "error", "message": "Login required"},
+                        )
+                        continue
+                    username = session_user["username"]
+                    quantity = request.get("quantity")
+                    if quantity is not None and int(quantity) <= 0:
+                        send(
+                            writer,
+                            {"status": "error", "message": "Quantity must be positive"},
+                        )
+                        continue
+                    cart_remove(
+                        username,
+                        request["product_id"],
+                        None if quantity is None else int(quantity),
+                    )
+                    with carts_lock:
+                        items = cart_items(username)
+                    send(writer, {"status": "success", "cart": items})
+
+                elif action == "cart_clear":
+                    if not session_user:
+                        send(
+                            writer,
+                            {"status": "error", "message": "Login required"},
+                        )
+                        continue
+                    clear_cart(session_user["username"])
+                    send(writer, {"status": "success", "cart": []})
+
+                elif action == "cart_get":
+                    if not session_user:
+                        send(
+                            writer,
+                            {"status": "error", "message": "Login required"},
+                        )
+                        continue
+                    username = session_user["username"]
+                    with carts_lock:
+                        evict_expired_carts(time.monotonic())
+                        items = cart_items(username)
+                    send(writer, {"status": "success", "cart": items})
 
-                    send(client_socket, {"status": "success", "products": products})
+                elif action == "search_products":
+                    sort = request.get("sort", "name")
+                    if sort not in SORT_KEYS:
+                        send(
+                            writer,
+                            {"status": "error", "message": f"Unknown sort key: {sort}"},
+                        )
+                        continue
+
+                    limit = max(1, min(int(request.get("limit", 50)), 200))
+                    offset = max(0, int(request.get("offset", 0)))
+                    min_price_cents = request.get("min_price_cents")
+                    max_price_cents = request.get("max_price_cents")
+                    refresh_catalog(CATALOG_READ_MAX_AGE)
+                    total, products = catalog.search(
+                        query=request.get("query", "").strip(),
+                        mode="prefix" if request.get("prefix") else "substring",
+                        min_price_cents=(
+                            None if min_price_cents is None else int(min_price_cents)
+                        ),
+                        max_price_cents=(
+                            None if max_price_cents is None else int(max_price_cents)
+                        ),
+                        in_stock=bool(request.get("in_stock")),
+                        sort=sort,
+                        descending=bool(request.get("descending")),
+                        offset=offset,
+                        limit=limit,
+                    )
+                    send(
+                        writer,
+                        {"status": "success", "products": products, "total": total},
+                    )
 
                 elif action == "checkout":
-                    username = request["username"]
-                    cart = request["cart"]
+                    if not session_user:
+                        send(
+                            writer,
+                            {"status": "error", "message": "Login required"},
+                        )
+                        continue
+                    username = session_user["username"]
+                    key = request.get("idempotency_key")
+                    if key:
+                        previous = get_checkout_result(username, key)
+                        if previous is not None:
+                            send(writer, dict(previous, replayed=True))
+                            continue
+
+                    # Only the server cart is trusted: its quantities were
+                    # checked when the items were added.
+                    with carts_lock:
+                        cart = cart_items(username)
+                    if not cart:
+                        send_checkout_result(
+                            writer,
+                            username,
+                            key,
+                            {"status": "error", "message": "Cart is empty"},
+                        )
+                        continue
+                    trace.mark("cart")
+
                     cursor.execute(
                         "SELECT id FROM users WHERE username=%s", (username,)
                     )
                     user = cursor.fetchone()
+                    trace.mark("user_lookup")
                     if not user:
-                        send(
-                            client_socket,
+                        send_checkout_result(
+                            writer,
+                            username,
+                            key,
                             {"status": "error", "message": "User not found"},
                         )
                         continue
 
                     user_id = user["id"]
-                    updated_products = []
 
-                    valid_order = True
+                    # The result cache may have evicted this key; the
+                    # order_headers table is the source of truth for checkouts.
+                    if key:
+                        cursor.execute(
+                            "SELECT id, total_cents FROM order_headers WHERE user_id=%s AND idempotency_key=%s",
+                            (user_id, key),
+                        )
+                        header = cursor.fetchone()
+                        trace.mark("idempotency_lookup")
+                        if header:
+                            send_checkout_result(
+                                writer,
+                                username,
+                                key,
+                                {
+                                    "status": "success",
+                                    "order_id": header["id"],
+                                    "total_cents": header["total_cents"],
+                                },
+                            )
+                            continue
+
+                    quantities = {}
                     for item in cart:
-                        product_id = item["id"]
-                        quantity = item["quantity"]
+                        quantities[item["id"]] = (
+                            quantities.get(item["id"], 0) + item["quantity"]
+                        )
 
+                    # Inserting the header first takes the idempotency key's
+                    # unique lock, so a concurrent retry waits for this one.
+                    try:
                         cursor.execute(
-                            "SELECT stock FROM products WHERE id=%s", (product_id,)
+                            "INSERT INTO order_headers (user_id, idempotency_key) VALUES (%s, %s)",
+                            (user_id, key),
                         )
-                        product = cursor.fetchone()
-                        if not product or product["stock"] < quantity:
-                            send(
-                                client_socket,
+                    except mysql.connector.errors.IntegrityError:
+                        conn.rollback()
+                        cursor.execute(
+                            "SELECT id, total_cents FROM order_headers WHERE user_id=%s AND idempotency_key=%s",
+                            (user_id, key),
+                        )
+                        header = cursor.fetchone()
+                        send_checkout_result(
+                            writer,
+                            username,
+                            key,
+                            {
+                                "status": "success",
+                                "order_id": header["id"],
+                                "total_cents": header["total_cents"],
+                            },
+                        )
+                        continue
+                    order_id = cursor.lastrowid
+                    trace.mark("insert_header")
+
+                    updated_products = []
+
+                    # Items were validated when they were added to the cart, so
+                    # the stock check and decrement collapse into one guarded
+                    # UPDATE per line instead of a separate SELECT pass.
+                    valid_order = True
+                    for product_id, quantity in quantities.items():
+                        cursor.execute(
+                            "UPDATE products SET stock = stock - %s WHERE id = %s AND stock >= %s",
+                            (quantity, product_id, quantity),
+                        )
+                        trace.mark("stock_update")
+                        if cursor.rowcount == 0:
+                            conn.rollback()
+                            send_checkout_result(
+                                writer,
+                                username,
+                                key,
                                 {
                                     "status": "error",
                                     "message": f"Insufficient stock for product ID {product_id}",
@@ -194,68 +1523,175 @@ def handle_client(client_socket, client_address):
                             valid_order = False
                             break
 
+                        cursor.execute(
+                            "SELECT stock, price_cents, updated_at FROM products WHERE id=%s",
+                            (product_id,),
+                        )
+                        product = cursor.fetchone()
+                        trace.mark("stock_select")
+                        updated_products.append(
+                            (
+                                product_id,
+                                product["stock"],
+                                quantity,
+                                product["price_cents"],
+                                format_version(product["updated_at"]),
+                            )
+                        )
+
                     if not valid_order:
                         continue
 
-                    for item in cart:
-                        product_id = item["id"]
-                        quantity = item["quantity"]
+                    # The total is computed here from prices read inside the
+                    # transaction; it is the amount the client should show.
+                    total_cents = sum(
+                        quantity * price_cents
+                        for _, _, quantity, price_cents, _ in updated_products
+                    )
 
-                        cursor.execute(
-                            "INSERT INTO orders (user_id, product_id, quantity) VALUES (%s, %s, %s)",
-                            (user_id, product_id, quantity),
+                    # executemany turns this into a single multi-row INSERT
+                    cursor.executemany(
+                        "INSERT INTO order_lines (order_id, product_id, quantity, unit_price_cents) VALUES (%s, %s, %s, %s)",
+                        [
+                            (order_id, product[0], product[2], product[3])
+                            for product in updated_products
+                        ],
+                    )
+                    cursor.execute(
+                        "UPDATE order_headers SET total_cents = %s WHERE id = %s",
+                        (total_cents, order_id),
+                    )
+                    trace.mark("insert_lines")
+
+                    conn.commit()
+                    trace.mark("commit")
+                    clear_cart(username)
+                    send_checkout_result(
+                        writer,
+                        username,
+                        key,
+                        {
+                            "status": "success",
+                            "order_id": order_id,
+                            "total_cents": total_cents,
+                        },
+                    )
+                    trace.mark("send")
+
+                    for product_id, _, quantity, price_cents, _ in updated_products:
+                        record_sale(product_id, quantity, price_cents)
+                    for product_id, new_stock, _, _, version in updated_products:
+                        catalog.update_stock(product_id, new_stock, version)
+                        broadcast_stock_update(product_id, new_stock, version)
+                    trace.mark("broadcast")
+
+                elif action == "get_history":
+                    if not session_user:
+                        send(
+                            writer,
+                            {"status": "error", "message": "Login required"},
                         )
+                        continue
+
+                    user_id = session_user["id"]
+                    limit = max(
+                        1, min(int(request.get("limit", HISTORY_PAGE_SIZE)), 100)
+                    )
+                    before_id = request.get("before_id")
 
+                    # Keyset pagination over (user_id, id), newest first. One
+                    # extra row tells us whether there is another page.
+                    if before_id is None:
                         cursor.execute(
-                            "UPDATE products SET stock = stock - %s WHERE id = %s",
-                            (quantity, product_id),
+                            """
+                            SELECT id, order_time, total_cents FROM order_headers
+                            WHERE user_id = %s
+                            ORDER BY id DESC LIMIT %s
+                            """,
+                            (user_id, limit + 1),
                         )
-
+                    else:
                         cursor.execute(
-                            "SELECT stock FROM products WHERE id=%s", (product_id,)
+                            """
+                            SELECT id, order_time, total_cents FROM order_headers
+                            WHERE user_id = %s AND id < %s
+                            ORDER BY id DESC LIMIT %s
+                            """,
+                            (user_id, before_id, limit + 1),
                         )
-                        new_stock = cursor.fetchone()["stock"]
-                        updated_products.append((product_id, new_stock))
-
-                    conn.commit()
-                    send(client_socket, {"status": "success"})
+                    headers = cursor.fetchall()
+                    next_cursor = None
+                    if len(headers) > limit:
+                        headers = headers[:limit]
+                        next_cursor = headers[-1]["id"]
 
-                    for product_id, new_stock in updated_products:
-                        broadcast_stock_update(product_id, new_stock)
+                    orders = attach_order_lines(cursor, headers)
 
-                elif action == "get_history":
-                    username = request["username"]
-                    cursor.execute(
-                        "SELECT id FROM users WHERE username=%s", (username,)
+                    send(
+                        writer,
+                        {
+                            "status": "success",
+                            "orders": orders,
+                            "next_cursor": next_cursor,
+                        },
                     )
-                    user = cursor.fetchone()
-                    if not user:
+
+                elif action == "get_stats":
+                    if not session_user or not session_user["is_admin"]:
                         send(
-                            client_socket,
-                            {"status": "error", "message": "User not found"},
+                            writer,
+                            {"status": "error", "message": "Admin login required"},
                         )
                         continue
 
-                    user_id = user["id"]
-                    cursor.execute(
-                        """
-                        SELECT orders.id, orders.product_id, orders.quantity, orders.order_time, products.name AS product_name
-                        FROM orders
-                        JOIN products ON orders.product_id = products.id
-                        WHERE orders.user_id = %s
-                        """,
-                        (user_id,),
+                    products, hours = sales_snapshot()
+                    conn.commit()
+                    cursor.execute("SELECT id, name FROM products")
+                    names = {row["id"]: row["name"] for row in cursor.fetchall()}
+                    for product in products:
+                        product["name"] = names.get(product["product_id"], "")
+                    products.sort(
+                        key=lambda product: product["units_today"], reverse=True
+                    )
+
+                    send(
+                        writer,
+                        {
+                            "status": "success",
+                            "products": products,
+                            "hours": hours,
+                            "reconnects": reconnect_stats(),
+                        },
                     )
-                    orders = cursor.fetchall()
 
-                    for order in orders:
-                        order["order_time"] = order["order_time"].isoformat()
+                elif action == "get_traces":
+                    if not session_user or not session_user["is_admin"]:
+                        send(
+                            writer,
+                            {"status": "error", "message": "Admin login required"},
+                        )
+                        continue
+
+                    # Optional knobs so tracing can be switched on in production
+                    if "sample_rate" in request:
+                        rate = float(request["sample_rate"])
+                        tracer.sample_rate = min(max(rate, 0.0), 1.0)
+                    traces = tracer.snapshot()
+                    if request.get("reset"):
+                        tracer.reset()
 
-                    send(client_socket, {"status": "success", "orders": orders})
+                    send(
+                        writer,
+                        {
+                            "status": "success",
+                            "sample_rate": tracer.sample_rate,
+                            "traces": traces,
+                        },
+                    )
 
                 else:
                     send(
-                        client_socket, {"status": "error", "message": "Unknown action"}
+                        writer, {"status": "error", "message": "Unknown action"}
                     )
 
             except socket.timeout:
@@ -265,14 +1701,14 @@ def handle_client(client_socket, client_address):
             except json.JSONDecodeError:
                 print(f"[SERVER] Invalid JSON from client {client_id}")
                 send(
-                    client_socket, {"status": "error", "message": "Invalid JSON format"}
+                    writer, {"status": "error", "message": "Invalid JSON format"}
                 )
 
             except Exception as e:
                 print(f"[ERROR] {str(e)}")
                 try:
                     send(
-                        client_socket,
+                        writer,
                         {"status": "error", "message": f"Exception occurred: {str(e)}"},
                     )
                 except:
@@ -280,44 +1716,83 @@ def handle_client(client_socket, client_address):
                 break
 
     finally:
+        if busy:
+            tracer.finish(trace)
+            end_request()
 
         cursor.close()
-        conn.close()
+        release_connection(conn)
+
+        if capture_writer is not None:
+            capture_writer.record(connection_id, capture.CLOSE)
 
         with clients_lock:
-            if client_id in connected_clients:
+            if connected_clients.get(client_id) is writer:
                 del connected_clients[client_id]
 
+        writer.close(5)
         try:
             client_socket.close()
         except:
             pass
 
 
-def send(sock, data):
-    try:
-        sock.sendall(json.dumps(data).encode("utf-8"))
-    except Exception as e:
-        print(f"[SEND ERROR] {str(e)}")
-        raise
+def send(writer, data):
+    writer.write(encode_message(data))
 
 
-def start_server(host="0.0.0.0", port=9998):
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((host, port))
-    server.listen(5)
+def start_server(host="0.0.0.0", port=9998, listen_fd=None):
+    if listen_fd is not None:
+        server = socket.socket(fileno=listen_fd)
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        # A deep backlog absorbs the reconnect burst after a restart
+        server.listen(socket.SOMAXCONN)
+    # Wake up periodically so a shutdown request is noticed promptly
+    server.settimeout(1.0)
     print(f"[SERVER] Listening on {host}:{port}")
 
+    # Accept right away; health reports not ready until warm-up finishes
+    threading.Thread(target=warm_up, daemon=True).start()
+
+    handoff = threading.Event()
+
+    def request_shutdown(signum, frame):
+        shutting_down.set()
+
+    def request_handoff(signum, frame):
+        handoff.set()
+        shutting_down.set()
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, request_handoff)
+
+    threading.Thread(target=stats_flusher, daemon=True).start()
+    threading.Thread(target=catalog_refresher, daemon=True).start()
+
     try:
-        while True:
-            client_sock, addr = server.accept()
+        while not shutting_down.is_set():
+            try:
+                client_sock, addr = server.accept()
+            except socket.timeout:
+                continue
+            client_sock.settimeout(None)
             print(f"[SERVER] Connection from {addr} with socket number {client_sock.fileno()}")
             threading.Thread(target=handle_client, args=(client_sock, addr)).start()
     except KeyboardInterrupt:
-        print("[SERVER] Shutting down...")
+        shutting_down.set()
     finally:
+        print("[SERVER] Shutting down...")
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        if handoff.is_set():
+            spawn_successor(server)
         server.close()
+        drain(deadline)
+        if capture_writer is not None:
+            capture_writer.close()
 
 
 if __name__ == "__main__":
@@ -326,7 +1801,27 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Shopping App Server")
     parser.add_argument("--host", default="0.0.0.0", help="Host address to bind to")
     parser.add_argument("--port", type=int, default=9998, help="Port to listen on")
+    parser.add_argument(
+        "--listen-fd",
+        type=int,
+        help="Inherited listening socket (used for restarts on SIGHUP)",
+    )
+    parser.add_argument(
+        "--trace-sample",
+        type=float,
+        default=TRACE_SAMPLE_RATE,
+        help="Fraction of requests to trace (0 disables tracing)",
+    )
+    parser.add_argument(
+        "--capture",
+        metavar="PATH",
+        help="Append every received request to PATH for replay.py",
+    )
 
     args = parser.parse_args()
 
-    start_server(args.host, args.port)
+    tracer.sample_rate = args.trace_sample
+    if args.capture:
+        capture_writer = capture.CaptureWriter(args.capture)
+    init_db()
+    start_server(args.host, args.port, args.listen_fd)
@@ -0,0 +1,93 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+class Trace:
+    """Per-stage timings for one request.
+
+    Each mark() closes the span that started at the previous mark, so a
+    handler only has to name the stage it just finished.
+    """
+
+    def __init__(self, client_id, started):
+        self.client_id = client_id
+        self.action = None
+        self.wall_time = time.time()
+        self.started = started
+        self.last = started
+        self.spans = []
+        self.total = 0.0
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.spans.append((stage, now - self.last))
+        self.last = now
+
+    def finish(self):
+        self.mark("handle")
+        self.total = self.last - self.started
+
+    def to_dict(self):
+        return {
+            "client_id": self.client_id,
+            "action": self.action,
+            "time": self.wall_time,
+            "total_ms": round(self.total * 1000, 3),
+            "spans": [
+                {"stage": stage, "ms": round(elapsed * 1000, 3)}
+                for stage, elapsed in self.spans
+            ],
+        }
+
+
+class NullTrace:
+    """Stand-in for unsampled requests; every call is a no-op."""
+
+    action = None
+
+    def mark(self, stage):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class Tracer:
+    """Samples requests and keeps the slowest traces seen so far."""
+
+    def __init__(self, keep=50, sample_rate=0.0):
+        self.keep = keep
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        # Min-heap on total time, so the fastest kept trace is evicted first
+        self.slowest = []
+        self.counter = itertools.count()
+
+    def start(self, client_id, started):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return NULL_TRACE
+        return Trace(client_id, started)
+
+    def finish(self, trace):
+        if trace is NULL_TRACE:
+            return
+        trace.finish()
+        entry = (trace.total, next(self.counter), trace)
+        with self.lock:
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, entry)
+            elif trace.total > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def snapshot(self):
+        """Return the kept traces as dicts, slowest first."""
+        with self.lock:
+            entries = sorted(self.slowest, reverse=True)
+        return [trace.to_dict() for _, _, trace in entries]
+
+    def reset(self):
+        with self.lock:
+            self.slowest = []
@@ -0,0 +1,162 @@
+import collections
+import itertools
+import json
+import socket
+import threading
+import time
+
+# Per-connection output buffer limits. Above HIGH_WATER a connection stops
+# accepting writes: handlers wait until it drains below LOW_WATER, while
+# broadcasts get False back and can drop the slow client.
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+WRITE_TIMEOUT = 30
+# Most platforms cap a single scatter write at 1024 buffers
+MAX_IOV = 1024
+# Longest request a peer may send; without a cap, a peer that never sends
+# a newline would grow the read buffer without bound
+MAX_MESSAGE_SIZE = 64 * 1024
+
+
+def encode_message(data):
+    """Serialize one protocol message: compact JSON terminated by a newline.
+
+    The result is immutable, so a payload sent to many clients (broadcasts,
+    the catalog) is encoded once and the same bytes object is queued for each.
+    """
+    return json.dumps(data, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+class MessageReader:
+    """Splits the incoming byte stream into newline-delimited messages."""
+
+    def __init__(self, sock, max_size=MAX_MESSAGE_SIZE):
+        self.sock = sock
+        # None disables the limit, e.g. for reading server responses
+        self.max_size = max_size
+        self.buffer = b""
+        # perf_counter() when the next message started arriving, or when
+        # read() came back for one already buffered behind an earlier one
+        self.received_at = 0.0
+
+    def read(self):
+        """Return the next message, or None once the peer has disconnected."""
+        if self.buffer:
+            # Data left behind by the previous message was waiting on its
+            # handler; time this one from when it is picked up
+            self.received_at = time.perf_counter()
+        while True:
+            line, separator, rest = self.buffer.partition(b"\n")
+            if self.max_size is not None and len(line) > self.max_size:
+                raise ConnectionError("Message too long")
+            if separator:
+                self.buffer = rest
+                if line.strip():
+                    return line
+                continue
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            if not self.buffer:
+                self.received_at = time.perf_counter()
+            self.buffer += data
+
+
+class ClientWriter:
+    """Buffered, coalescing writer for one client socket.
+
+    Producers append encoded messages; a dedicated thread drains the queue,
+    handing every pending buffer to the kernel in one sendmsg() call where
+    the platform supports scatter I/O.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.chunks = collections.deque()
+        self.buffered = 0
+        self.closed = False
+        self.aborted = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, payload, block=True):
+        """Queue payload. Returns False if the buffer is full and block is False."""
+        with self.cond:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            if self.buffered >= HIGH_WATER:
+                if not block:
+                    return False
+                drained = self.cond.wait_for(
+                    lambda: self.buffered <= LOW_WATER or self.closed,
+                    WRITE_TIMEOUT,
+                )
+                if self.closed:
+                    raise ConnectionError("Connection closed")
+                if not drained:
+                    raise TimeoutError("Client is not reading")
+            self.chunks.append(payload)
+            self.buffered += len(payload)
+            self.cond.notify_all()
+        return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.chunks or self.closed)
+                if not self.chunks:
+                    return
+                batch = list(itertools.islice(self.chunks, MAX_IOV))
+
+            try:
+                if hasattr(self.sock, "sendmsg"):
+                    sent = self.sock.sendmsg(batch)
+                else:
+                    data = b"".join(batch)
+                    self.sock.sendall(data)
+                    sent = len(data)
+            except OSError as e:
+                print(f"[SEND ERROR] {str(e)}")
+                with self.cond:
+                    self.aborted = True
+                    self.closed = True
+                    self.chunks.clear()
+                    self.buffered = 0
+                    self.cond.notify_all()
+                return
+
+            with self.cond:
+                if self.aborted:
+                    return
+                self.buffered -= sent
+                while sent:
+                    first = self.chunks[0]
+                    if len(first) <= sent:
+                        self.chunks.popleft()
+                        sent -= len(first)
+                    else:
+                        self.chunks[0] = memoryview(first)[sent:]
+                        sent = 0
+                if self.buffered <= LOW_WATER:
+                    self.cond.notify_all()
+
+    def close(self, timeout=None):
+        """Stop accepting writes and wait up to timeout for queued data to flush."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+
+    def abort(self):
+        """Drop the connection without flushing queued data."""
+        with self.cond:
+            self.closed = True
+            self.aborted = True
+            self.chunks.clear()
+            self.buffered = 0
+            self.cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass